@@ -1,12 +1,22 @@
+import time as t
+SCRIPT_STARTED = t.perf_counter() # 起動時間の計測用 (import より前に測る)
 import streamlit as st
 import pandas as pd
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import numpy as np
+# gspread / oauth2client は読み込みに時間がかかるため、スプレッドシートを使う処理の中で import する
 from datetime import datetime, time, timedelta, date, timezone
 import math
-import time as t
 import uuid
 import calendar
+import threading
+import sqlite3
+import fcntl
+import os
+import json
+import contextvars
+import functools
+import random
+from collections import OrderedDict, Counter, deque
 
 # --- 設定 ---
 WORK_START_HOUR = 9
@@ -18,123 +28,1433 @@ MAX_DAILY_FINE = 1000
 # 日本時間 (JST)
 JST = timezone(timedelta(hours=9))
 
+# シートの列定義 (列番号はこの順番から求める)
+USER_COLS = ["id", "name", "rest_balance", "paid_leave_balance", "initial_fine", "last_reset_week", "last_reset_month"]
+RECORD_COLS = ["id", "user_id", "date", "clock_in", "clock_out", "status", "fine", "note"]
+# 数値として扱う列の型。users のスナップショットはこの型 (空欄は 0)、残りの列は文字列で持つ
+NUMERIC_COLS = {"rest_balance": "float64", "paid_leave_balance": "float64", "initial_fine": "float64", "fine": "int64"}
+# 先月以前の records を移す月別シートの名前 (records_2025-08 など)
+ARCHIVE_PREFIX = "records_"
+
+def get_setting(key, default=None):
+    """設定値を 環境変数 (ATTENDANCE_<KEY>) → st.secrets の順に探す"""
+    env = os.environ.get(f"ATTENDANCE_{key.upper()}")
+    if env is not None: return env
+    try: return st.secrets.get(key, default)
+    except Exception: return default
+
+def to_plain(value):
+    # numpy型は JSON / sqlite3 に渡せないため Python の型に戻す
+    return value.item() if hasattr(value, 'item') else value
+
 # --- Google Sheets 接続設定 (キャッシュ化) ---
 @st.cache_resource
 def connect_to_gsheets():
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
     scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
     creds_dict = dict(st.secrets["gcp_service_account"])
     creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
     client = gspread.authorize(creds)
     sheet_url = st.secrets["spreadsheet_url"]
     sh = client.open_by_url(sheet_url)
-    return sh
+    return Instrumented(sh)
+
+# --- API 呼び出しの計測 ---
+@st.cache_resource
+def context_var(name, default):
+    # Streamlit は再実行のたびにスクリプトを新しいモジュールとして実行するため、
+    # キャッシュした計測用のオブジェクトと同じ ContextVar を使うようにプロセスで1つだけ作る
+    return contextvars.ContextVar(name, default=default)
+
+# 呼び出しは「どの操作から出たか」(出勤・付与など) ごとに記録する。操作名は api_action で付ける
+API_ACTION = context_var("api_action", "page_view")
+
+def estimate_size(value):
+    """送受信データのおおよそのバイト数 (行が多いときは先頭100行から見積もる)"""
+    if isinstance(value, dict): return sum(estimate_size(k) + estimate_size(v) + 2 for k, v in value.items()) + 2
+    if isinstance(value, (list, tuple)):
+        if len(value) > 100: return estimate_size(value[:100]) * len(value) // 100
+        return sum(estimate_size(v) + 1 for v in value) + 2
+    if value is None: return 4
+    return len(str(value).encode())
+
+class ApiMetrics:
+    """API 呼び出しの記録 (直近 max_events 件)。プロセス全体で1つ"""
+    def __init__(self, max_events=20000):
+        self.lock = threading.Lock()
+        self.events = deque(maxlen=max_events)
+
+    def record(self, method, sheet, ms, sent, received, error=""):
+        event = {"ts": round(t.time(), 3), "action": API_ACTION.get(), "method": method, "sheet": sheet,
+                 "ms": round(ms, 1), "sent": sent, "received": received, "error": error}
+        with self.lock: self.events.append(event)
+
+    def error(self, exc):
+        """握りつぶした例外も、その時点の操作名で記録しておく"""
+        self.record("(exception)", "", 0.0, 0, 0, f"{type(exc).__name__}: {exc}")
+
+    def frame(self, since=0.0):
+        with self.lock: events = [e for e in self.events if e["ts"] >= since]
+        return pd.DataFrame(events, columns=["ts", "action", "method", "sheet", "ms", "sent", "received", "error"])
+
+    def summary(self, since=0.0):
+        """操作・メソッドごとの 回数 / エラー数 / 所要時間の分位点 / 転送量"""
+        df = self.frame(since)
+        if df.empty: return df
+        df = df.assign(failed=df['error'] != "", kb=(df['sent'] + df['received']) / 1024)
+        g = df.groupby(['action', 'method'])
+        out = g.agg(calls=('ms', 'size'), errors=('failed', 'sum'), kb=('kb', 'sum'))
+        for q in (50, 95, 99): out[f"p{q}_ms"] = g['ms'].quantile(q / 100)
+        return out.reset_index().sort_values('calls', ascending=False)
+
+    def to_jsonl(self, since=0.0):
+        with self.lock: events = [e for e in self.events if e["ts"] >= since]
+        return "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in events)
+
+@st.cache_resource
+def get_metrics():
+    return ApiMetrics(int(get_setting("metrics_max_events", 20000)))
+
+def api_action(func):
+    """関数の中で発生した API 呼び出しをその関数名で記録する (外側の操作名が優先)"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if API_ACTION.get() != "page_view": return func(*args, **kwargs)
+        token = API_ACTION.set(func.__name__)
+        try: return func(*args, **kwargs)
+        finally: API_ACTION.reset(token)
+    return wrapper
+
+# --- API のリクエスト制御 (クォータ・優先度・再試行) ---
+WRITE_METHODS = {"values_batch_update", "append_rows", "append_row", "update", "update_cell", "batch_update", "delete_rows", "clear", "add_worksheet"}
+# 5xx (届いたかどうか分からない失敗) のときに送り直すと二重に反映されうるもの。429 は未処理なので送り直してよい
+UNSAFE_RETRY_METHODS = {"append_rows", "append_row", "delete_rows", "add_worksheet"}
+BACKGROUND_ACTIONS = {"snapshot_refresh", "auto_force_checkout", "force_checkout", "run_global_auto_grant", "grant_periodic_leave",
+                      "auto_fill_missing_days_all", "recompute_fines", "export_to_sheets", "import_from_sheets",
+                      "rollover_records"}
+
+class TokenBucket:
+    """1分あたり per_minute 回まで。空の状態から1秒に per_minute / 60 個ずつ溜まる"""
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = t.monotonic()
+
+    def refill(self):
+        now = t.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+class RequestScheduler:
+    """全セッション共通のリクエスト制御。
+
+    読み取り・書き込みをそれぞれトークンバケツで1分あたりの上限内に収める。
+    順番待ちは 利用者の書き込み (0) > 利用者の読み取り (1) > バックグラウンド処理 (2) の順で、
+    バックグラウンド処理はバケツに reserve の割合以上残っているときだけ送る。
+    429 / 5xx はジッター付きの指数バックオフで同じリクエストをそのまま送り直す。
+    書き込みは1つの操作の分を1回のリクエストにまとめてあるので、途中までの状態が再送されることはない。
+    """
+    def __init__(self, per_minute=60, reserve=0.25, max_retries=5, base_delay=1.0, max_delay=32.0):
+        self.cond = threading.Condition()
+        self.buckets = {"read": TokenBucket(per_minute), "write": TokenBucket(per_minute)}
+        self.reserve = reserve
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.waiting = Counter()
+
+    def priority(self, kind):
+        if API_ACTION.get() in BACKGROUND_ACTIONS: return 2
+        return 0 if kind == "write" else 1
+
+    def acquire(self, kind, priority):
+        bucket = self.buckets[kind]
+        floor = bucket.capacity * self.reserve if priority == 2 else 0.0
+        with self.cond:
+            self.waiting[(kind, priority)] += 1
+            try:
+                while True:
+                    bucket.refill()
+                    ahead = any(self.waiting[(kind, p)] for p in range(priority))
+                    if not ahead and bucket.tokens >= 1 + floor:
+                        bucket.tokens -= 1
+                        return
+                    self.cond.wait(max(0.05, (1 + floor - bucket.tokens) / bucket.rate))
+            finally:
+                self.waiting[(kind, priority)] -= 1
+                self.cond.notify_all()
+
+    def call(self, method, send):
+        """send() を上限内で実行し、一時的な失敗なら送り直す"""
+        kind = "write" if method in WRITE_METHODS else "read"
+        priority = self.priority(kind)
+        for attempt in range(self.max_retries + 1):
+            self.acquire(kind, priority)
+            try: return send()
+            except Exception as e:
+                code = getattr(e, 'code', None)
+                if not isinstance(code, int): raise
+                retriable = code == 429 or (code >= 500 and method not in UNSAFE_RETRY_METHODS)
+                if not retriable or attempt == self.max_retries: raise
+                if code == 429:
+                    with self.cond: self.buckets[kind].tokens = 0.0 # 他のセッションもしばらく送らない
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+                t.sleep(delay / 2 + random.uniform(0, delay / 2))
+
+@st.cache_resource
+def get_scheduler():
+    return RequestScheduler(per_minute=int(get_setting("sheets_quota_per_min", 60)),
+                            max_retries=int(get_setting("api_max_retries", 5)))
+
+class Instrumented:
+    """gspread の Spreadsheet / Worksheet を包み、メソッドの呼び出しごとに get_metrics() へ記録する。
+    呼び出しは get_scheduler() を通して送る"""
+    def __init__(self, target, sheet=""):
+        self._target = target
+        self._sheet = sheet
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith('_') or not callable(attr): return attr
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            def send():
+                started = t.perf_counter()
+                try: result = attr(*args, **kwargs)
+                except Exception as e:
+                    get_metrics().record(name, self._sheet, (t.perf_counter() - started) * 1000, estimate_size([args, kwargs]), 0, f"{type(e).__name__}: {e}")
+                    raise
+                get_metrics().record(name, self._sheet, (t.perf_counter() - started) * 1000, estimate_size([args, kwargs]), estimate_size(result))
+                return result
+            result = get_scheduler().call(name, send)
+            if name in ("worksheet", "add_worksheet"): return Instrumented(result, result.title)
+            if name == "worksheets": return [Instrumented(ws, ws.title) for ws in result]
+            return result
+        return call
+
+# --- 行番号インデックス ---
+class RowIndex:
+    """id -> シート上の行番号 の対応表。
+
+    シートを読み込むたびに作り直し、行の追加・削除のたびに更新する。
+    version は書き込みのたびに進み、取得中に書き込みがあった古いデータで
+    作り直してしまうのを防ぐ。
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.built = False
+        self.version = 0
+
+    def rebuild(self, ids, version):
+        with self.lock:
+            if version != self.version: return
+            self.rows = {str(v): i + 2 for i, v in enumerate(ids)}
+            self.built = True
+
+    def get(self, key):
+        with self.lock:
+            return self.rows.get(str(key))
+
+    def appended(self, ids, first_row):
+        with self.lock:
+            for i, v in enumerate(ids): self.rows[str(v)] = first_row + i
+            self.version += 1
+
+    def deleted(self, row):
+        with self.lock:
+            self.rows = {k: (r - 1 if r > row else r) for k, r in self.rows.items() if r != row}
+            self.version += 1
+
+    def invalidate(self):
+        with self.lock:
+            self.rows = {}
+            self.built = False
+            self.version += 1
+
+def record_key(user_id, date_str):
+    return f"{user_id}|{date_str}"
+
+class RecordKeyIndex(RowIndex):
+    """(user_id, date) -> records シート上の行番号。
+
+    同じ日の行が複数あるときは最初の行 (find_record が返す行)。
+    records シートの行は月の切り替え・全件の置き換えのときしか消えないので、そのときは作り直す。
+    """
+    def rebuild(self, records_df, version):
+        keys = (records_df['user_id'].astype(str) + "|" + records_df['date'].astype(str)).tolist() if not records_df.empty else []
+        with self.lock:
+            if version != self.version: return
+            self.rows = dict(zip(reversed(keys), range(len(keys) + 1, 1, -1))) # 後ろから入れて最初の行を残す
+            self.built = True
+
+    def appended(self, keys, first_row):
+        with self.lock:
+            for i, k in enumerate(keys): self.rows.setdefault(str(k), first_row + i)
+            self.version += 1
+
+def first_record(df, user_id, date_str):
+    """df の中の (user_id, date) の最初の行 (dict)。無ければ None"""
+    if df.empty: return None
+    rec = df[(df['user_id'].astype(str) == str(user_id)) & (df['date'].astype(str) == str(date_str))]
+    return rec.iloc[0].to_dict() if not rec.empty else None
+
+# --- 未退勤レコードのインデックス ---
+def is_open_shift(clock_out):
+    return clock_out is None or str(clock_out).strip() == ""
+
+class OpenShiftIndex:
+    """user_id -> clock_out が空のレコード (シートの行順) の対応表。
+
+    records の読み込み時に作り直し、出勤・退勤・強制退勤のたびに put() で更新する。
+    退勤と強制退勤はここだけを見ればよく、全件を読み直す必要がない。
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.shifts = {}
+        self.built = False
+        self.version = 0
+
+    def rebuild(self, records_df, version):
+        with self.lock:
+            if version != self.version: return
+            self.shifts = {}
+            if not records_df.empty:
+                open_df = records_df[records_df['clock_out'].map(is_open_shift)]
+                for rec in open_df.to_dict('records'):
+                    self.shifts.setdefault(str(rec['user_id']), {})[str(rec['id'])] = rec
+            self.built = True
+
+    def put(self, rec):
+        """レコードの最新の内容を反映する (clock_out が埋まっていれば外す)"""
+        with self.lock:
+            uid, rid = str(rec['user_id']), str(rec['id'])
+            if is_open_shift(rec['clock_out']):
+                self.shifts.setdefault(uid, {})[rid] = dict(rec)
+            elif rid in self.shifts.get(uid, {}):
+                del self.shifts[uid][rid]
+                if not self.shifts[uid]: del self.shifts[uid]
+            self.version += 1
+
+    def get(self, rec_id):
+        with self.lock:
+            for recs in self.shifts.values():
+                if str(rec_id) in recs: return dict(recs[str(rec_id)])
+            return None
+
+    def for_user(self, user_id):
+        with self.lock:
+            return [dict(r) for r in self.shifts.get(str(user_id), {}).values()]
+
+    def all(self):
+        with self.lock:
+            return [dict(r) for recs in self.shifts.values() for r in recs.values()]
+
+    def invalidate(self):
+        with self.lock:
+            self.shifts = {}
+            self.built = False
+            self.version += 1
+
+# --- 書き込みの一括化 ---
+class SheetBatch:
+    """1回の操作で発生するセル更新を集め、values_batch_update 1回で送信する。
+
+    with SheetBatch() as b: の形で使い、ブロックを抜けた時点でまとめて書き込む。
+    同じ行で隣り合う列は1つの範囲にまとめる。
+    """
+    def __init__(self, sh=None):
+        self.sh = sh
+        self.cells = {}
+
+    def set(self, sheet_name, row, col, value):
+        self.cells[(sheet_name, row, col)] = to_plain(value)
+
+    def set_fields(self, sheet_name, row, fields):
+        cols = USER_COLS if sheet_name == "users" else RECORD_COLS
+        for col_name, value in fields.items():
+            self.set(sheet_name, row, cols.index(col_name) + 1, value)
+
+    def ranges(self):
+        from gspread.utils import rowcol_to_a1, absolute_range_name
+        data = []
+        for (sheet_name, row, col) in sorted(self.cells):
+            value = self.cells[(sheet_name, row, col)]
+            last = data[-1] if data else None
+            if last and last['sheet'] == sheet_name and last['row'] == row and last['end'] == col - 1:
+                last['values'].append(value)
+                last['end'] = col
+            else:
+                data.append({'sheet': sheet_name, 'row': row, 'start': col, 'end': col, 'values': [value]})
+        return [{"range": absolute_range_name(d['sheet'], f"{rowcol_to_a1(d['row'], d['start'])}:{rowcol_to_a1(d['row'], d['end'])}"),
+                 "values": [d['values']]} for d in data]
+
+    def commit(self):
+        if not self.cells: return None
+        sh = self.sh or connect_to_gsheets()
+        res = sh.values_batch_update(body={"valueInputOption": "USER_ENTERED", "data": self.ranges()})
+        self.cells = {}
+        return res
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None: self.commit()
+
+# --- 保存先 (ストレージ) ---
+# アプリが使う操作だけを揃えた共通インターフェース。
+#   load_users / add_user / update_users / increment_user_field / delete_user
+#   load_records / append_records / update_records
+#   load_versioned (users / records と、内容が変わったかを判定する番号。判定できなければ None)
+#   find_record (user_id, date) / open_shifts / records_between (日付範囲)
+#   replace_all (一括入れ替え。移行・書き出し用)
+#   archive_months / load_archive / rollover (先月以前の records を月別に分けて保存する。Sheets のみ)
+# 行は USER_COLS / RECORD_COLS の順のリスト、更新は {id: {列名: 値}} で渡す。
+class SheetsStorage:
+    """Google スプレッドシートに直接保存する (従来の動作)"""
+    name = "sheets"
+
+    def __init__(self, sh=None):
+        self.sh = sh
+        self.row_index = {"users": RowIndex(), "records": RowIndex()}
+        self.record_keys = RecordKeyIndex()
+        self.shifts = OpenShiftIndex()
+        self.frames = {} # シート名 -> (直近に読み込んだ DataFrame, 取得時刻)
+        self.versions = {} # シート名 -> 読み込んだ内容が変わるたびに進む番号
+        # records の差分同期: 前回までの DataFrame・行数・書き換えた行を覚え、追加分だけを取得する。
+        # 他プロセスでの書き換えや行削除は full_sync_sec ごとの全件読み込みで取り込む
+        self.incremental = get_setting("sync_mode", "incremental") == "incremental"
+        self.full_sync_sec = float(get_setting("full_sync_sec", 300))
+        self.synced = {}
+        self.load_lock = threading.Lock()
+        # 月別アーカイブ: シート一覧と読み込んだ月の DataFrame。一覧は full_sync_sec ごとに取り直す
+        self.archive_list = None # (月の一覧, 取得時刻)
+        self.archive_frames = {} # 'YYYY-MM' -> DataFrame
+
+    def worksheet(self, name):
+        return (self.sh or connect_to_gsheets()).worksheet(name)
+
+    def init(self):
+        """両シートの見出し行 (1行目) だけを1回で読み、空のシートに見出しを書く"""
+        from gspread.utils import rowcol_to_a1, absolute_range_name
+        sheets = (("users", USER_COLS), ("records", RECORD_COLS))
+        ranges = [absolute_range_name(name, f"A1:{rowcol_to_a1(1, len(cols))}") for name, cols in sheets]
+        res = (self.sh or connect_to_gsheets()).values_batch_get(ranges)
+        for (name, cols), vr in zip(sheets, res.get('valueRanges', [])):
+            if not vr.get('values'): self.worksheet(name).append_row(cols)
+
+    def load(self, name):
+        return self.load_versioned(name)[0]
+
+    def load_versioned(self, name):
+        """(DataFrame, 番号)。番号は同じロックの中で読むので、DataFrame と必ず対応する"""
+        with self.load_lock:
+            synced = self.synced.get(name)
+            # 索引を捨てた後 (invalidate) は差分だけでは作り直せないので全件を読む
+            indexes = [self.row_index[name]] + ([self.shifts, self.record_keys] if name == "records" else [])
+            if synced and t.time() - synced['full_at'] < self.full_sync_sec and all(i.built for i in indexes):
+                df = self.sync_tail(name, synced)
+            else: df = self.load_full(name)
+            return df, self.versions.get(name, 0)
+
+    def load_full(self, name):
+        cols = USER_COLS if name == "users" else RECORD_COLS
+        ws = self.worksheet(name)
+        index = self.row_index[name]
+        version, shifts_version, keys_version = index.version, self.shifts.version, self.record_keys.version
+        df = pd.DataFrame(ws.get_all_records())
+        if df.empty: df = pd.DataFrame(columns=cols)
+        elif not set(cols).issubset(df.columns): return pd.DataFrame(columns=cols)
+        index.rebuild(df['id'], version)
+        if name == "records":
+            self.shifts.rebuild(df, shifts_version)
+            self.record_keys.rebuild(df, keys_version)
+            if self.incremental:
+                self.synced[name] = {'df': df, 'header': list(df.columns), 'full_at': t.time(), 'dirty': set()}
+        self.frames[name] = (df, t.time())
+        self.versions[name] = self.versions.get(name, 0) + 1
+        return df
+
+    def sync_tail(self, name, synced):
+        """前回の読み込み以降に追加された行と、書き換えた行だけを batch_get 1回で取得して反映する。
+
+        最後に読んだ行の id も一緒に読み、変わっていれば (他のプロセスでの行削除・月の切り替え) 全件を読み直す。
+        """
+        from gspread.utils import rowcol_to_a1, numericise_all, to_records
+        df, header = synced['df'], synced['header']
+        last_col = rowcol_to_a1(1, len(header))[:-1]
+        first_new = len(df) + 2
+        dirty = sorted(r for r in synced['dirty'] if r < first_new)
+        if len(dirty) > max(100, len(df) // 10): return self.load_full(name) # 大量に書き換えた後は全件読む方が軽い
+        ranges = [f"A{first_new}:{last_col}"] + [f"A{r}:{last_col}{r}" for r in dirty]
+        if len(df): ranges.append(f"A{first_new - 1}")
+        results = self.worksheet(name).batch_get(ranges)
+        if len(df):
+            last = results.pop()
+            if not last or not last[0] or str(last[0][0]) != str(df['id'].iloc[-1]): return self.load_full(name)
+        synced['dirty'] -= set(dirty)
+        pad = lambda values: numericise_all(list(values) + [""] * (len(header) - len(values)))
+        new_recs = to_records(header, [pad(v) for v in results[0]])
+        if not new_recs and not dirty:
+            self.frames[name] = (df, t.time())
+            return df
+        df = df.copy()
+        if dirty:
+            patch = pd.DataFrame([pad(vr[0] if vr else []) for vr in results[1:]], columns=header)
+            positions = [r - 2 for r in dirty]
+            for j, col in enumerate(header): # 列ごとにまとめて書き換える
+                try: df.iloc[positions, j] = patch[col].to_numpy()
+                except (TypeError, ValueError):
+                    df[col] = df[col].astype(object)
+                    df.iloc[positions, j] = patch[col].to_numpy()
+            if name == "records":
+                for rec in patch.to_dict('records'): self.shifts.put(rec)
+        if new_recs:
+            df = pd.concat([df, pd.DataFrame(new_recs, columns=header)], ignore_index=True)
+            self.row_index[name].appended([r['id'] for r in new_recs], first_new)
+            if name == "records":
+                self.record_keys.appended([record_key(r['user_id'], r['date']) for r in new_recs], first_new)
+                for rec in new_recs: self.shifts.put(rec)
+        synced['df'] = df
+        self.frames[name] = (df, t.time())
+        self.versions[name] = self.versions.get(name, 0) + 1
+        return df
+
+    def frame(self, name, max_age=5):
+        """直近に読み込んだ DataFrame。max_age 秒より古い、または書き込み後なら読み直す"""
+        cached = self.frames.get(name)
+        if cached and t.time() - cached[1] < max_age: return cached[0]
+        return self.load(name)
+
+    def row_of(self, name, key):
+        """id の行番号。インデックスから引き、無い場合のみシートを検索する"""
+        if not self.row_index[name].built: self.load(name)
+        row = self.row_index[name].get(key)
+        if row: return row
+        try:
+            cell = self.worksheet(name).find(str(key), in_column=1)
+            return cell.row if cell else None
+        except: return None
+
+    def append(self, name, rows):
+        rows = [[to_plain(v) for v in r] for r in rows]
+        res = self.worksheet(name).append_rows(rows)
+        index = self.row_index[name]
+        try:
+            from gspread.utils import a1_to_rowcol
+            first_row = a1_to_rowcol(res['updates']['updatedRange'].split('!')[-1].split(':')[0])[0]
+            index.appended([r[0] for r in rows], first_row)
+            if name == "records": self.record_keys.appended([record_key(r[1], r[2]) for r in rows], first_row)
+        except Exception:
+            index.invalidate()
+            if name == "records": self.record_keys.invalidate()
+        if name == "records":
+            for r in rows: self.shifts.put(dict(zip(RECORD_COLS, r)))
+        self.frames.pop(name, None)
+        return res
+
+    def update(self, name, updates):
+        count = 0
+        with SheetBatch(self.sh) as b:
+            for key, fields in updates.items():
+                row = self.row_of(name, key)
+                if not row: continue
+                b.set_fields(name, row, fields)
+                if name in self.synced: self.synced[name]['dirty'].add(row)
+                count += 1
+        self.frames.pop(name, None)
+        return count
+
+    def load_users(self):
+        return self.load("users")
+
+    def add_user(self, row):
+        self.append("users", [row])
+
+    def update_users(self, updates):
+        return self.update("users", updates)
+
+    def increment_user_field(self, user_id, col_name, amount):
+        row = self.row_of("users", user_id)
+        if not row: return False
+        col = USER_COLS.index(col_name) + 1
+        val = self.worksheet("users").cell(row, col).value
+        try:
+            current_val = float(val) if val else 0.0
+        except:
+            current_val = 0.0
+        with SheetBatch(self.sh) as b: b.set("users", row, col, current_val + float(amount))
+        self.frames.pop("users", None)
+        return True
+
+    def delete_user(self, user_id):
+        row = self.row_of("users", user_id)
+        if not row: return False
+        self.worksheet("users").delete_rows(row)
+        self.row_index["users"].deleted(row)
+        self.frames.pop("users", None)
+        return True
+
+    def load_records(self):
+        return self.load("records")
+
+    def append_records(self, rows):
+        self.append("records", rows)
+
+    def update_records(self, updates):
+        # records シートに無い id はアーカイブを探す (管理画面からの過去の修正など)
+        if not self.row_index["records"].built: self.load("records")
+        missing = [k for k in updates if not self.row_index["records"].get(k)]
+        archived = self.update_archive({k: updates[k] for k in missing}) if missing and self.archive_months() else set()
+        count = len(archived) + self.update("records", {k: v for k, v in updates.items() if k not in archived})
+        for rec_id, fields in updates.items():
+            current = self.shifts.get(rec_id)
+            if current: self.shifts.put({**current, **fields})
+            elif 'clock_out' in fields and is_open_shift(fields['clock_out']):
+                self.shifts.invalidate() # 全休・有休への変更などで未退勤に戻ったため作り直す
+        return count
+
+    def find_record(self, user_id, date_str):
+        """records シートは (user_id, date) の索引から行を引く。先月以前の日付のときだけアーカイブも探す"""
+        rec = first_record(self.with_archive(pd.DataFrame(columns=RECORD_COLS), date_str, date_str), user_id, date_str)
+        if rec: return rec
+        df = self.frame("records") # 古ければ差分同期する (他のプロセスが追加した行も索引に入る)
+        key = record_key(user_id, date_str)
+        if self.record_keys.built:
+            row = self.record_keys.get(key)
+            if row is None: return None
+            if row - 2 < len(df):
+                rec = df.iloc[row - 2].to_dict()
+                if record_key(rec['user_id'], rec['date']) == key: return rec
+        return first_record(df, user_id, date_str) # 索引が作り直し中、または読み込み中に行がずれたとき
+
+    def open_shifts(self, user_id=None):
+        if not self.shifts.built: self.load("records")
+        if user_id is None: return self.shifts.all()
+        recs = self.shifts.for_user(user_id)
+        if not recs:
+            # インデックスに無い場合のみ読み直して確認する
+            self.load("records")
+            recs = self.shifts.for_user(user_id)
+        return recs
+
+    def records_between(self, start_str, end_str, user_id=None):
+        df = self.with_archive(self.frame("records"), start_str, end_str)
+        if df.empty: return df
+        mask = (df['date'].astype(str) >= start_str) & (df['date'].astype(str) <= end_str)
+        if user_id is not None: mask &= df['user_id'].astype(str) == str(user_id)
+        return df[mask]
+
+    def replace_all(self, users_df, records_df):
+        for name, cols, df in (("users", USER_COLS, users_df), ("records", RECORD_COLS, records_df)):
+            ws = self.worksheet(name)
+            values = [cols] + [[to_plain(v) for v in r] for r in df[cols].itertuples(index=False)]
+            ws.clear()
+            ws.update(values=values, range_name="A1")
+            self.row_index[name].invalidate()
+            self.frames.pop(name, None)
+            self.synced.pop(name, None)
+        self.record_keys.invalidate()
+        self.shifts.invalidate()
+        # 全件を records シートへ書いたので、月別のシートは消す (次の rollover で分け直す)
+        sh = self.sh or connect_to_gsheets()
+        self.archive_list = None
+        for month in self.archive_months(): sh.del_worksheet(sh.worksheet(ARCHIVE_PREFIX + month))
+        self.archive_list, self.archive_frames = None, {}
+
+    # --- 月別アーカイブ ---
+    # records シートには今月分 (と未退勤の行) だけを残し、先月以前は月ごとのシートへ移す。
+    # 日々の打刻・集計は records シートだけを読み、過去の期間にかかる参照のときだけアーカイブを読む。
+    def archive_months(self):
+        """アーカイブ済みの月 ('YYYY-MM') の一覧 (古い順)"""
+        cached = self.archive_list
+        if cached and t.time() - cached[1] < self.full_sync_sec: return cached[0]
+        titles = [ws.title for ws in (self.sh or connect_to_gsheets()).worksheets()]
+        months = sorted(x[len(ARCHIVE_PREFIX):] for x in titles if x.startswith(ARCHIVE_PREFIX))
+        self.archive_list, self.archive_frames = (months, t.time()), {} # 他のプロセスでの書き換えもここで取り込む
+        return months
+
+    def load_archive(self, months=None):
+        """アーカイブの records (months を省略すると全月)。まだ読んでいない月だけを values_batch_get 1回で読む"""
+        available = self.archive_months()
+        months = available if months is None else [m for m in months if m in available]
+        missing = [m for m in months if m not in self.archive_frames]
+        if missing:
+            from gspread.utils import rowcol_to_a1, absolute_range_name, numericise_all, to_records
+            last_col = rowcol_to_a1(1, len(RECORD_COLS))[:-1]
+            res = (self.sh or connect_to_gsheets()).values_batch_get([absolute_range_name(ARCHIVE_PREFIX + m, f"A:{last_col}") for m in missing])
+            for month, vr in zip(missing, res.get('valueRanges', [])):
+                values = vr.get('values', [])
+                header = values[0] if values else RECORD_COLS
+                recs = to_records(header, [numericise_all(list(v) + [""] * (len(header) - len(v))) for v in values[1:]])
+                self.archive_frames[month] = pd.DataFrame(recs, columns=header).reindex(columns=RECORD_COLS)
+        frames = [self.archive_frames[m] for m in months if m in self.archive_frames]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=RECORD_COLS)
+
+    def with_archive(self, df, start_str, end_str):
+        """期間が先月以前にかかるときだけ、該当する月のアーカイブを df の前に足す"""
+        if str(start_str) >= datetime.now(JST).strftime('%Y-%m'): return df
+        months = [m for m in self.archive_months() if str(start_str)[:7] <= m <= str(end_str)[:7]]
+        return pd.concat([self.load_archive(months), df], ignore_index=True) if months else df
+
+    def update_archive(self, updates):
+        """アーカイブ済みの行を書き換え、見つかった id の集合を返す"""
+        self.load_archive()
+        found = set()
+        with SheetBatch(self.sh) as b:
+            for month, df in self.archive_frames.items():
+                for key, pos in zip(list(updates), id_positions(df, updates)):
+                    if pos < 0 or key in found: continue
+                    b.set_fields(ARCHIVE_PREFIX + month, int(pos) + 2, updates[key])
+                    for col, value in updates[key].items(): set_cell(df, pos, col, value)
+                    found.add(key)
+        return found
+
+    def rollover(self, now=None):
+        """先月以前の行を月別のアーカイブシートへ移し、records シートから消す。{月: 移した件数} を返す。
+
+        未退勤の行は強制退勤の対象なので残す。アーカイブ済みの id は追加しないので、途中で失敗しても再実行できる。
+        行を消すと他のプロセスが覚えている行番号がずれるため、書き込みの少ない時間に1か所からだけ実行する。
+        """
+        now = now or datetime.now(JST)
+        with self.load_lock: df = self.load_full("records")
+        if df.empty: return {}
+        months = parse_dates(df['date']).dt.strftime('%Y-%m')
+        old = (months < now.strftime('%Y-%m')).to_numpy() & ~df['clock_out'].map(is_open_shift).to_numpy()
+        if not old.any(): return {}
+        sh = self.sh or connect_to_gsheets()
+        existing = {ws.title: ws for ws in sh.worksheets()}
+        moved = {}
+        for month, part in df[old].groupby(months[old]):
+            ws = existing.get(ARCHIVE_PREFIX + month)
+            if ws is None:
+                ws = sh.add_worksheet(title=ARCHIVE_PREFIX + month, rows=len(part) + 1, cols=len(RECORD_COLS))
+                rows = [RECORD_COLS]
+            else:
+                part = part[~part['id'].astype(str).isin(ws.col_values(1)[1:])]
+                rows = []
+            rows += [[to_plain(v) for v in r] for r in part[RECORD_COLS].itertuples(index=False)]
+            if rows: ws.append_rows(rows)
+            moved[month] = len(part)
+        # 移した行を、連続する範囲ごとに下から消す (1回の batch_update)
+        rows = np.flatnonzero(old) + 1 # 0 始まりの行番号 (見出し行の分 +1)
+        breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+        runs = [(int(r[0]), int(r[-1]) + 1) for r in np.split(rows, breaks)]
+        sheet_id = self.worksheet("records").id
+        sh.batch_update({"requests": [{"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": start, "endIndex": end}}}
+                                      for start, end in reversed(runs)]})
+        self.row_index["records"].invalidate()
+        self.record_keys.invalidate()
+        self.shifts.invalidate()
+        self.frames.pop("records", None)
+        self.synced.pop("records", None)
+        self.archive_list, self.archive_frames = None, {}
+        return moved
+
+class SQLiteStorage:
+    """ローカルの SQLite ファイルに保存する。
+
+    (user_id, date)・date・未退勤 (clock_out = '') にインデックスを張り、
+    打刻や検索をシート全体の読み込みなしで行う。
+    """
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+
+    def init(self):
+        with self.lock, self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id TEXT PRIMARY KEY, name TEXT NOT NULL DEFAULT '',
+                    rest_balance REAL NOT NULL DEFAULT 0, paid_leave_balance REAL NOT NULL DEFAULT 0,
+                    initial_fine INTEGER NOT NULL DEFAULT 0,
+                    last_reset_week TEXT NOT NULL DEFAULT '', last_reset_month TEXT NOT NULL DEFAULT '');
+                CREATE TABLE IF NOT EXISTS records (
+                    id TEXT PRIMARY KEY, user_id TEXT NOT NULL, date TEXT NOT NULL,
+                    clock_in TEXT NOT NULL DEFAULT '', clock_out TEXT NOT NULL DEFAULT '',
+                    status TEXT NOT NULL DEFAULT '', fine INTEGER NOT NULL DEFAULT 0, note TEXT NOT NULL DEFAULT '');
+                CREATE INDEX IF NOT EXISTS idx_records_user_date ON records (user_id, date);
+                CREATE INDEX IF NOT EXISTS idx_records_date ON records (date);
+                CREATE INDEX IF NOT EXISTS idx_records_open ON records (user_id) WHERE clock_out = '';
+            """)
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return [dict(r) for r in self.conn.execute(sql, params).fetchall()]
+
+    def frame(self, table, where="", params=()):
+        cols = USER_COLS if table == "users" else RECORD_COLS
+        rows = self.query(f"SELECT {', '.join(cols)} FROM {table} {where} ORDER BY rowid", params)
+        return pd.DataFrame(rows, columns=cols)
+
+    def insert(self, table, rows):
+        with self.lock, self.conn: self.insert_rows(table, rows)
+
+    def insert_rows(self, table, rows):
+        """ロックとトランザクションは呼び出し側で取る"""
+        cols = USER_COLS if table == "users" else RECORD_COLS
+        values = [["" if v is None else to_plain(v) for v in r] for r in rows]
+        self.conn.executemany(f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})", values)
+
+    def update(self, table, updates):
+        cols = USER_COLS if table == "users" else RECORD_COLS
+        count = 0
+        with self.lock, self.conn:
+            for key, fields in updates.items():
+                names = [c for c in fields if c in cols and c != "id"]
+                if not names: continue
+                sql = f"UPDATE {table} SET {', '.join(f'{c} = ?' for c in names)} WHERE id = ?"
+                params = ["" if fields[c] is None else to_plain(fields[c]) for c in names] + [str(key)]
+                count += self.conn.execute(sql, params).rowcount
+        return count
+
+    def load_users(self):
+        return self.frame("users")
+
+    def load_versioned(self, name):
+        """番号は読む前に取る (読んだ後の変更は次の番号の違いで分かる)。data_version は他の接続、total_changes はこの接続の変更で進む"""
+        with self.lock: version = (self.conn.execute("PRAGMA data_version").fetchone()[0], self.conn.total_changes)
+        return self.frame(name), version
+
+    def add_user(self, row):
+        self.insert("users", [row])
+
+    def update_users(self, updates):
+        return self.update("users", updates)
+
+    def increment_user_field(self, user_id, col_name, amount):
+        if col_name not in USER_COLS: raise ValueError(col_name)
+        with self.lock, self.conn:
+            cur = self.conn.execute(f"UPDATE users SET {col_name} = COALESCE({col_name}, 0) + ? WHERE id = ?", (float(amount), str(user_id)))
+            return cur.rowcount > 0
+
+    def delete_user(self, user_id):
+        with self.lock, self.conn:
+            return self.conn.execute("DELETE FROM users WHERE id = ?", (str(user_id),)).rowcount > 0
+
+    def load_records(self):
+        return self.frame("records")
+
+    def append_records(self, rows):
+        self.insert("records", rows)
+
+    def update_records(self, updates):
+        return self.update("records", updates)
+
+    def find_record(self, user_id, date_str):
+        rows = self.query(f"SELECT {', '.join(RECORD_COLS)} FROM records WHERE user_id = ? AND date = ? ORDER BY rowid LIMIT 1", (str(user_id), date_str))
+        return rows[0] if rows else None
+
+    def open_shifts(self, user_id=None):
+        if user_id is None:
+            return self.query(f"SELECT {', '.join(RECORD_COLS)} FROM records WHERE clock_out = '' ORDER BY rowid")
+        return self.query(f"SELECT {', '.join(RECORD_COLS)} FROM records WHERE clock_out = '' AND user_id = ? ORDER BY rowid", (str(user_id),))
+
+    def records_between(self, start_str, end_str, user_id=None):
+        if user_id is None:
+            return self.frame("records", "WHERE date BETWEEN ? AND ?", (start_str, end_str))
+        return self.frame("records", "WHERE user_id = ? AND date BETWEEN ? AND ?", (str(user_id), start_str, end_str))
+
+    def replace_all(self, users_df, records_df):
+        # 途中で失敗しても元の内容が残るよう、削除と追加を1つのトランザクションで行う
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM users")
+            self.conn.execute("DELETE FROM records")
+            self.insert_rows("users", users_df[USER_COLS].itertuples(index=False))
+            self.insert_rows("records", records_df[RECORD_COLS].itertuples(index=False))
+
+    # インデックスで期間を絞れるので月別には分けない
+    def archive_months(self):
+        return []
+
+    def load_archive(self, months=None):
+        return pd.DataFrame(columns=RECORD_COLS)
+
+    def rollover(self, now=None):
+        return {}
+
+# --- 書き込みの後回し (write-behind) ---
+def set_cell(df, pos, col, value):
+    try: df.iat[pos, df.columns.get_loc(col)] = value
+    except (TypeError, ValueError):
+        df[col] = df[col].astype(object)
+        df.iat[pos, df.columns.get_loc(col)] = value
+
+def id_positions(df, keys):
+    """各 id の行位置 (無ければ -1)。同じ id が複数あるときは先頭の行"""
+    ids = pd.Index(df['id'].astype(str))
+    keys = [str(k) for k in keys]
+    if ids.is_unique: return ids.get_indexer(keys)
+    first = pd.Series(np.arange(len(ids)), index=ids)[~ids.duplicated()]
+    return first.reindex(keys).fillna(-1).astype(int).to_numpy()
+
+def apply_journal(df, entries, cols):
+    """未反映の journal (追加・更新・削除) を DataFrame に重ねる。反映済みの分を重ねても結果は変わらない"""
+    df = df.copy() if not df.empty else pd.DataFrame(columns=cols)
+    for _, _, kind, payload in entries:
+        if kind == "append":
+            found = id_positions(df, [r[0] for r in payload])
+            new = [r for r, pos in zip(payload, found) if pos < 0]
+            if new: df = pd.concat([df, pd.DataFrame(new, columns=cols)], ignore_index=True)
+        elif kind == "update":
+            for pos, fields in zip(id_positions(df, payload), payload.values()):
+                if pos < 0: continue
+                for col, value in fields.items(): set_cell(df, pos, col, value)
+        elif kind == "delete":
+            df = df[df['id'].astype(str) != payload].reset_index(drop=True)
+    return df
+
+class JournaledStorage:
+    """書き込みをローカルの journal (SQLite, WAL) に記録してすぐに返し、
+    バックグラウンドのスレッドが記録順にまとめて inner (SheetsStorage) へ反映する。
+
+    読み出しは inner の内容に未反映の記録を重ねて返す。journal は再起動後も残り、起動時に続きから反映する。
+    再起動前に反映済みだったかもしれない追加行は、シート上の id と突き合わせて二重に追加しない。
+    反映に max_attempts 回失敗した記録は保留 (failed) にして管理者タブに表示する。
+    """
+    def __init__(self, inner, path, interval=1.0, max_attempts=10):
+        self.inner = inner
+        self.name = inner.name
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS journal (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT, created REAL NOT NULL, op TEXT NOT NULL, payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0, error TEXT NOT NULL DEFAULT '')""")
+        self.pending = self.read_journal("attempts < ?")
+        self.recover_until = self.pending[-1][0] if self.pending else 0 # ここまでは反映済みの可能性がある
+        self.wake = threading.Event()
+        self.worker = None
+        if self.pending: self.start()
+
+    def read_journal(self, where):
+        rows = self.conn.execute(f"SELECT seq, op, payload FROM journal WHERE {where} ORDER BY seq", (self.max_attempts,)).fetchall()
+        return [(seq, *op.split("."), json.loads(payload)) for seq, op, payload in rows]
+
+    # 書き込み (journal に記録するだけ)
+    def log(self, table, kind, payload):
+        with self.lock, self.conn:
+            seq = self.conn.execute("INSERT INTO journal (created, op, payload) VALUES (?, ?, ?)",
+                                    (t.time(), f"{table}.{kind}", json.dumps(payload, ensure_ascii=False))).lastrowid
+            self.pending.append((seq, table, kind, payload))
+        self.start()
+        self.wake.set()
+
+    def known_ids(self, name, ids):
+        """ids のうち存在する id。records シートに無い records の id はアーカイブも探す (反映は inner.update_records が振り分ける)"""
+        ids = {str(i) for i in ids}
+        known = set(self.view(name)['id'].astype(str)) & ids
+        if name == "records" and known != ids and self.inner.archive_months():
+            known |= set(self.inner.load_archive()['id'].astype(str)) & ids
+        return known
+
+    def add_user(self, row):
+        self.log("users", "append", [[to_plain(v) for v in row]])
+
+    def update_users(self, updates):
+        return self.log_updates("users", updates)
+
+    def increment_user_field(self, user_id, col_name, amount):
+        # 加算ではなく結果の値を記録する (再送しても二重に足されない)
+        users = self.view("users")
+        cur = users[users['id'].astype(str) == str(user_id)]
+        if cur.empty: return False
+        try: current = float(cur.iloc[0][col_name]) if cur.iloc[0][col_name] != "" else 0.0
+        except: current = 0.0
+        self.log("users", "update", {str(user_id): {col_name: current + float(amount)}})
+        return True
+
+    def delete_user(self, user_id):
+        if not self.known_ids("users", [user_id]): return False
+        self.log("users", "delete", str(user_id))
+        return True
+
+    def append_records(self, rows):
+        self.log("records", "append", [[to_plain(v) for v in r] for r in rows])
+
+    def update_records(self, updates):
+        return self.log_updates("records", updates)
+
+    def log_updates(self, table, updates):
+        known = self.known_ids(table, updates)
+        updates = {str(k): {c: to_plain(v) for c, v in f.items()} for k, f in updates.items() if str(k) in known}
+        if updates: self.log(table, "update", updates)
+        return len(updates)
+
+    # 読み出し (未反映の記録を重ねる)
+    def pending_for(self, name):
+        with self.lock: return [e for e in self.pending if e[1] == name]
+
+    def view(self, name):
+        """直近に読み込んだ内容 + 未反映の記録"""
+        entries = self.pending_for(name) # 先に取ってから読むので、読み込み中に反映された分も欠けない
+        df = self.inner.frame(name)
+        return apply_journal(df, entries, USER_COLS if name == "users" else RECORD_COLS) if entries else df
+
+    def init(self):
+        self.inner.init()
+
+    def load_users(self):
+        entries = self.pending_for("users")
+        return apply_journal(self.inner.load_users(), entries, USER_COLS) if entries else self.inner.load_users()
+
+    def load_records(self):
+        entries = self.pending_for("records")
+        return apply_journal(self.inner.load_records(), entries, RECORD_COLS) if entries else self.inner.load_records()
+
+    def load_versioned(self, name):
+        """inner の番号に、重ねた未反映の記録 (最後の通し番号と件数) を足したもの"""
+        entries = self.pending_for(name)
+        df, version = self.inner.load_versioned(name)
+        if entries: df = apply_journal(df, entries, USER_COLS if name == "users" else RECORD_COLS)
+        return df, (version, entries[-1][0] if entries else 0, len(entries))
+
+    def find_record(self, user_id, date_str):
+        """inner の索引で引いた行に、未反映の追加・更新だけを重ねる (全件に journal を重ねない)"""
+        entries = self.pending_for("records")
+        rec = self.inner.find_record(user_id, date_str)
+        key = record_key(user_id, date_str)
+        for _, _, kind, payload in entries:
+            if kind == "append" and rec is None:
+                rec = next((dict(zip(RECORD_COLS, r)) for r in payload if record_key(r[1], r[2]) == key), None)
+            elif kind == "update" and rec is not None and str(rec['id']) in payload:
+                rec = {**rec, **payload[str(rec['id'])]}
+        return rec
+
+    def open_shifts(self, user_id=None):
+        if not self.pending_for("records"): return self.inner.open_shifts(user_id)
+        df = self.view("records")
+        mask = df['clock_out'].map(is_open_shift)
+        if user_id is not None: mask &= df['user_id'].astype(str) == str(user_id)
+        return df[mask].to_dict('records')
+
+    def records_between(self, start_str, end_str, user_id=None):
+        if not self.pending_for("records"): return self.inner.records_between(start_str, end_str, user_id)
+        df = self.inner.with_archive(self.view("records"), start_str, end_str)
+        mask = (df['date'].astype(str) >= start_str) & (df['date'].astype(str) <= end_str)
+        if user_id is not None: mask &= df['user_id'].astype(str) == str(user_id)
+        return df[mask]
+
+    def replace_all(self, users_df, records_df):
+        self.flush()
+        self.inner.replace_all(users_df, records_df)
+
+    def archive_months(self):
+        return self.inner.archive_months()
+
+    def load_archive(self, months=None):
+        return self.inner.load_archive(months)
+
+    def rollover(self, now=None):
+        self.flush() # 移す前に未反映の書き込みを records シートへ出しておく
+        return self.inner.rollover(now)
+
+    # 反映 (バックグラウンド)
+    def start(self):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, name="journal-flush", daemon=True)
+                self.worker.start()
+
+    def run(self):
+        API_ACTION.set("journal_flush")
+        failures = 0
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.flush()
+                failures = 0
+            except Exception as e:
+                get_metrics().error(e)
+                failures += 1
+                t.sleep(min(60, self.interval * 2 ** failures))
+
+    def flush(self):
+        """未反映の記録を順番に、同じ種類が続く分は1回にまとめて反映する"""
+        with self.flush_lock:
+            with self.lock: entries = list(self.pending)
+            self.flush_entries(entries)
+
+    def flush_entries(self, entries):
+        while entries:
+            table, kind = entries[0][1], entries[0][2]
+            n = 1
+            while n < len(entries) and entries[n][1:3] == (table, kind): n += 1
+            run, entries = entries[:n], entries[n:]
+            try: self.apply(table, kind, [e[3] for e in run], run[0][0] <= self.recover_until)
+            except Exception as e:
+                self.failed(run, e)
+                raise
+            self.done(run)
+
+    def apply(self, table, kind, payloads, recovering):
+        if kind == "append":
+            rows = [r for p in payloads for r in p]
+            if recovering:
+                existing = set(self.inner.load(table)['id'].astype(str))
+                rows = [r for r in rows if str(r[0]) not in existing]
+            if rows: self.inner.append(table, rows)
+        elif kind == "update":
+            merged = {}
+            for p in payloads:
+                for key, fields in p.items(): merged.setdefault(key, {}).update(fields)
+            if table == "users": self.inner.update_users(merged)
+            else: self.inner.update_records(merged)
+        elif kind == "delete":
+            for user_id in payloads: self.inner.delete_user(user_id)
+
+    def done(self, run):
+        seqs = [e[0] for e in run]
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM journal WHERE seq = ?", [(s,) for s in seqs])
+            self.pending = [e for e in self.pending if e[0] not in set(seqs)]
+
+    def failed(self, run, exc):
+        seqs = [e[0] for e in run]
+        with self.lock, self.conn:
+            self.conn.executemany("UPDATE journal SET attempts = attempts + 1, error = ? WHERE seq = ?",
+                                  [(f"{type(exc).__name__}: {exc}", s) for s in seqs])
+            given_up = {s for (s,) in self.conn.execute(f"SELECT seq FROM journal WHERE attempts >= ? AND seq IN ({','.join('?' * len(seqs))})", (self.max_attempts, *seqs))}
+            self.pending = [e for e in self.pending if e[0] not in given_up]
+            # 失敗した呼び出しも反映済みの可能性がある (5xx でも書き込まれていることがある) ので、再送時はシートの id と突き合わせる
+            self.recover_until = max(self.recover_until, run[-1][0])
+
+    def status(self):
+        """(未反映の件数, 最も古い未反映の経過秒, 保留中の記録の DataFrame)"""
+        with self.lock:
+            oldest = self.conn.execute("SELECT MIN(created) FROM journal WHERE attempts < ?", (self.max_attempts,)).fetchone()[0]
+            failed = pd.read_sql_query("SELECT seq, created, op, payload, attempts, error FROM journal WHERE attempts >= ? ORDER BY seq", self.conn, params=(self.max_attempts,))
+            return len(self.pending), (t.time() - oldest) if oldest else 0.0, failed
+
+    def retry_failed(self):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE journal SET attempts = 0 WHERE attempts >= ?", (self.max_attempts,))
+            self.pending = self.read_journal("attempts < ?")
+            if self.pending: self.recover_until = max(self.recover_until, self.pending[-1][0]) # 途中まで反映された可能性がある
+        self.start()
+        self.wake.set()
+
+@st.cache_resource
+def get_storage():
+    """設定 storage_backend ("sheets" / "sqlite") に応じた保存先を返す。
+    write_mode が "write_behind" のときは SheetsStorage を JournaledStorage で包む"""
+    if get_setting("storage_backend", "sheets") == "sqlite":
+        return SQLiteStorage(get_setting("sqlite_path", "attendance.db"))
+    if get_setting("write_mode", "direct") == "write_behind":
+        return JournaledStorage(SheetsStorage(), get_setting("journal_path", "journal.db"))
+    return SheetsStorage()
 
 # --- シート操作関数 ---
+@st.cache_resource
+def ensure_sheets():
+    # プロセスごとに1回だけ確認する (失敗したときはキャッシュされず、次の実行で再度確認する)
+    get_storage().init()
+    return True
+
+@api_action
 def init_sheets():
     try:
-        sh = connect_to_gsheets()
-        ws_users = sh.worksheet("users")
-        if not ws_users.get_all_values():
-            ws_users.append_row(["id", "name", "rest_balance", "paid_leave_balance", "initial_fine", "last_reset_week", "last_reset_month"])
-        ws_records = sh.worksheet("records")
-        if not ws_records.get_all_values():
-            ws_records.append_row(["id", "user_id", "date", "clock_in", "clock_out", "status", "fine", "note"])
+        ensure_sheets()
     except Exception as e:
         st.error(f"シート接続エラー: {e}")
 
-@st.cache_data(ttl=5)
-def get_users_stable():
-    if 'cached_users_df' not in st.session_state:
-        st.session_state.cached_users_df = pd.DataFrame()
-    for _ in range(3):
+# --- 起動時間の計測 ---
+class PhaseTimer:
+    """1回の実行 (スクリプトの先頭から) の区間ごとの所要時間 (ミリ秒)"""
+    def __init__(self, started):
+        self.last = started
+        self.phases = {}
+
+    def mark(self, name):
+        now = t.perf_counter()
+        self.phases[name] = round((now - self.last) * 1000, 1)
+        self.last = now
+
+class StartupReport:
+    """描画までの時間を記録する。プロセスで最初の実行 (デプロイ・再起動の直後) と、
+    各セッションの最初の実行 (新しいブラウザのタブ) を分けて残す"""
+    def __init__(self, max_runs=200):
+        self.lock = threading.Lock()
+        self.started_at = t.time()
+        self.first = None # プロセスで最初の実行の区間
+        self.sessions = deque(maxlen=max_runs)
+
+    def add(self, timer, first_in_session):
+        phases = {**timer.phases, 'total': round(sum(timer.phases.values()), 1)}
+        with self.lock:
+            if self.first is None: self.first = phases
+            elif first_in_session: self.sessions.append({'ts': t.time(), **phases})
+
+    def frame(self):
+        with self.lock: return pd.DataFrame(list(self.sessions))
+
+@st.cache_resource
+def get_startup_report():
+    return StartupReport()
+
+# --- 共有スナップショット ---
+class SharedSnapshot:
+    """プロセス全体で1つだけ持つ DataFrame のスナップショット (stale-while-revalidate)。
+
+    get() は手元の最新スナップショットを即座に返し、ttl 秒を過ぎていれば
+    バックグラウンドのスレッドに再取得を依頼する。取得に失敗しても前回の
+    スナップショットを使い続ける。待つのは起動直後の最初の1回だけ。
+    返す DataFrame は全セッションで共有しているので、呼び出し側で書き換えないこと。
+    version は中身が変わるたびに進む (集計結果のキャッシュのキーに使う)。
+    loader は (取得結果, 番号) を返す。convert があれば取得結果 (シートの値そのまま) を変換して持ち、
+    apply で patch を変換後の DataFrame に重ねる (変換前の DataFrame は持たない)。
+    番号が前回の変換時と同じなら変換しない (None なら毎回変換する)。
+    store (SnapshotFile) があれば再取得の結果をディスクにも保存し、起動直後はそれを返しながら読み直す。
+
+    書き込んだ側は patch() で結果 (追加行・変更したセル・削除) を直接反映し、読み直しを待たない。
+    patch には通し番号を付けて取得中の再取得と突き合わせ、取得開始より後の patch は
+    取得結果に重ね直す (patch は何度重ねても同じ結果になる形で渡す)。
+    """
+    def __init__(self, loader, columns, ttl=5, store=None, convert=None, apply=None):
+        self.loader = loader
+        self.columns = columns
+        self.convert = convert or (lambda df: df)
+        self.apply = apply or (lambda df, entries: apply_journal(df, entries, columns))
+        self.loaded = None # 直近に変換した取得結果の番号
+        self.ttl = ttl
+        self.store = store
+        self.saved_at = 0.0
+        self.df = None
+        self.version = 0
+        self.fetched_at = 0.0
+        self.error = None
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.worker = None
+        self.patch_lock = threading.Lock()
+        self.patch_seq = 0
+        self.patches = [] # 直近の再取得に含まれていないかもしれない patch
+
+    def get(self):
+        if self.df is None:
+            with self.lock:
+                if self.df is None and not self.restore(): self.refresh(retries=3)
+            if self.df is None: return self.convert(pd.DataFrame(columns=self.columns))
+        if t.time() - self.fetched_at >= self.ttl:
+            self.request_refresh()
+        return self.df
+
+    def restore(self):
+        """ディスクのスナップショットを読み込む。fetched_at は 0 のままにして、すぐに読み直させる"""
+        if self.store is None: return False
+        df = self.store.load()
+        if df is None: return False
+        with self.patch_lock:
+            self.df = df
+            self.version += 1
+        return True
+
+    def save(self):
+        if self.store is None or t.time() - self.saved_at < self.store.interval: return
+        self.saved_at = t.time()
+        try: self.store.save(self.df)
+        except Exception as e: get_metrics().error(e)
+
+    def refresh(self, retries=1):
+        for i in range(retries):
+            try:
+                seq = self.patch_seq
+                raw, loaded = self.loader()
+                same = loaded is not None and loaded == self.loaded and self.df is not None
+                df = None if same else self.convert(raw)
+                del raw
+                with self.patch_lock:
+                    self.patches = [p for p in self.patches if p[0] > seq]
+                    if df is not None: # 前回と同じ取得結果なら、patch を重ねた今の df をそのまま使う
+                        if self.patches: df = self.apply(df, self.patches) # 取得中に書き込まれた分
+                        self.df, self.loaded = df, loaded
+                        self.version += 1 # df を差し替えてから進める (versioned() と逆の順)
+                    self.fetched_at, self.error = t.time(), None
+                self.save()
+                return True
+            except Exception as e:
+                self.error = e
+                if i < retries - 1: t.sleep(1)
+        return False
+
+    def versioned(self):
+        """(DataFrame, 版) を返す。版を先に読むので、新しいデータに古い版が付くことはあっても逆はない"""
+        version = self.version
+        return self.get(), version
+
+    def request_refresh(self):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, name="snapshot-refresh", daemon=True)
+                self.worker.start()
+        self.wake.set()
+
+    def run(self):
+        API_ACTION.set("snapshot_refresh")
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            if not self.refresh(): t.sleep(1) # 失敗時は連続で取りに行かない
+
+    def patch(self, kind, payload):
+        """kind: "append" (行のリスト) / "update" ({id: {列: 値}}) / "delete" (id)。反映できなければ再取得する"""
+        with self.patch_lock:
+            self.patch_seq += 1
+            entry = (self.patch_seq, None, kind, payload)
+            if self.df is None: return # まだ読み込んでいない (初回の読み込みに含まれる)
+            try: df = self.apply(self.df, [entry])
+            except Exception as e:
+                get_metrics().error(e)
+                self.fetched_at = 0.0
+                self.request_refresh()
+                return
+            self.patches.append(entry)
+            self.df = df
+            self.version += 1
+
+    def invalidate(self):
+        """書き込み後に呼ぶ。読み出しは止めずに、すぐ再取得を始める"""
+        self.fetched_at = 0.0
+        if self.df is not None: self.request_refresh()
+
+# --- ディスクのスナップショット ---
+def typed_frame(df, columns):
+    """columns の順に、NUMERIC_COLS の列は数値 (空欄・解釈できない値は 0)、それ以外は文字列にそろえる"""
+    out = {}
+    for col in columns:
+        values = df[col] if col in df else pd.Series([""] * len(df), index=df.index)
+        if col in NUMERIC_COLS: out[col] = pd.to_numeric(values, errors='coerce').fillna(0).astype(NUMERIC_COLS[col])
+        else: out[col] = values.fillna("").astype(str)
+    return pd.DataFrame(out, columns=columns)
+
+class SnapshotFile:
+    """SharedSnapshot の中身 (変換後の DataFrame) を Arrow IPC (非圧縮) のファイルに保存し、起動時にメモリマップで読み込む。
+    列の型 (カテゴリ・日時) はそのまま保存する。
+
+    読み込むのは同じ保存先 (source) の、max_age 秒以内に保存したものだけ。
+    複数のプロセスが書いても壊れないよう、一時ファイルに書いてから置き換える。
+    """
+    def __init__(self, path, columns, source, max_age=86400, interval=60):
+        self.path = path
+        self.columns = columns
+        self.source = source
+        self.max_age = max_age
+        self.interval = interval # 保存の最短間隔 (秒)
+
+    def load(self):
         try:
-            sh = connect_to_gsheets()
-            ws = sh.worksheet("users")
-            data = ws.get_all_records()
-            df = pd.DataFrame(data)
-            expected_cols = ["id", "name", "rest_balance", "paid_leave_balance", "initial_fine", "last_reset_week", "last_reset_month"]
-            if df.empty or not set(expected_cols).issubset(df.columns):
-                return pd.DataFrame(columns=expected_cols)
-            st.session_state.cached_users_df = df
-            return df
-        except Exception: t.sleep(1)
-    return st.session_state.cached_users_df
+            import pyarrow.feather as feather
+            table = feather.read_table(self.path, memory_map=True)
+        except Exception: return None # 未保存・pyarrow なし・壊れたファイル
+        meta = table.schema.metadata or {}
+        if meta.get(b"source", b"").decode() != self.source or table.column_names != self.columns: return None
+        if t.time() - float(meta.get(b"saved_at", 0)) > self.max_age: return None
+        return table.to_pandas()
+
+    def save(self, df):
+        import pyarrow as pa
+        import pyarrow.feather as feather
+        table = pa.Table.from_pandas(df[self.columns], preserve_index=False)
+        table = table.replace_schema_metadata({"source": self.source, "saved_at": str(t.time())})
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        feather.write_feather(table, tmp, compression="uncompressed")
+        os.replace(tmp, self.path)
+
+def snapshot_store(name, columns):
+    """設定 snapshot_dir (空欄で保存しない) に置く name.arrow。保存先ごとに別のものとして扱う"""
+    directory = get_setting("snapshot_dir", "snapshots")
+    if not directory: return None
+    if get_setting("storage_backend", "sheets") == "sqlite": source = "sqlite:" + os.path.abspath(get_setting("sqlite_path", "attendance.db"))
+    else: source = "sheets:" + str(get_setting("spreadsheet_url", ""))
+    return SnapshotFile(os.path.join(directory, f"{name}.arrow"), columns, source,
+                        max_age=float(get_setting("snapshot_max_age_sec", 86400)), interval=float(get_setting("snapshot_save_sec", 60)))
+
+@st.cache_resource
+def get_snapshots():
+    # 取得結果は型付きの DataFrame に変換して持つ (「型付きの DataFrame」を参照)。
+    # archive (先月以前) は変更がまれなので長めの間隔で読み直す
+    users = dict(convert=lambda df: typed_frame(df, USER_COLS),
+                 apply=lambda df, entries: typed_frame(apply_journal(df, entries, USER_COLS), USER_COLS))
+    records = dict(convert=typed_records, apply=apply_typed_journal)
+    return {"users": SharedSnapshot(lambda: get_storage().load_versioned("users"), USER_COLS, store=snapshot_store("users", USER_COLS), **users),
+            "records": SharedSnapshot(lambda: get_storage().load_versioned("records"), RECORD_COLS, store=snapshot_store("records", TYPED_RECORD_COLS), **records),
+            "archive": SharedSnapshot(lambda: (get_storage().load_archive(), None), RECORD_COLS, ttl=float(get_setting("archive_ttl_sec", 600)),
+                                      store=snapshot_store("archive", TYPED_RECORD_COLS), **records)}
+
+def get_users_stable():
+    return get_snapshots()["users"].get()
+
+def get_users_typed():
+    """画面用の users (型付き)"""
+    return typed_snapshot("users")[0]
 
-@st.cache_data(ttl=5)
 def get_records_stable():
-    if 'cached_records_df' not in st.session_state:
-        st.session_state.cached_records_df = pd.DataFrame()
-    for _ in range(3):
-        try:
-            sh = connect_to_gsheets()
-            ws = sh.worksheet("records")
-            data = ws.get_all_records()
-            df = pd.DataFrame(data)
-            expected_cols = ["id", "user_id", "date", "clock_in", "clock_out", "status", "fine", "note"]
-            if df.empty or not set(expected_cols).issubset(df.columns):
-                return pd.DataFrame(columns=expected_cols)
-            st.session_state.cached_records_df = df
-            return df
-        except Exception: t.sleep(1)
-    return st.session_state.cached_records_df
+    return get_snapshots()["records"].get()
 
 def clear_cache():
-    get_users_stable.clear()
-    get_records_stable.clear()
+    for snapshot in get_snapshots().values(): snapshot.invalidate()
 
-def find_row_num(worksheet, col_name, value):
-    try:
-        cell = worksheet.find(str(value), in_column=worksheet.find(col_name).col)
-        return cell.row if cell else None
-    except: return None
+def patch_cache(name, kind, payload):
+    """書き込んだ結果を共有スナップショットに直接反映する (シートを読み直さない)"""
+    if kind == "update": payload = {str(k): {c: to_plain(v) for c, v in f.items()} for k, f in payload.items()}
+    elif kind == "append": payload = [[to_plain(v) for v in r] for r in payload]
+    else: payload = str(payload)
+    snapshots = get_snapshots()
+    snapshots[name].patch(kind, payload)
+    if name == "records" and kind == "update" and snapshots["archive"].df is not None:
+        # records シートに無い id はアーカイブ済みの行への修正
+        positions = id_positions(snapshots["records"].get(), payload)
+        archived = {k: f for (k, f), pos in zip(payload.items(), positions) if pos < 0}
+        if archived: snapshots["archive"].patch("update", archived)
 
+@api_action
 def add_user(name):
-    sh = connect_to_gsheets()
-    ws = sh.worksheet("users")
     new_id = str(uuid.uuid4())
-    ws.append_row([new_id, name, 0, 0, 0, "", ""])
-    clear_cache()
+    row = [new_id, name, 0, 0, 0, "", ""]
+    get_storage().add_user(row)
+    get_grant_state()["done"].clear() # 新しいユーザーは今期の付与対象
+    patch_cache("users", "append", [row])
 
+@api_action
 def update_user_balance(user_id, col_name, amount):
-    sh = connect_to_gsheets()
-    ws = sh.worksheet("users")
-    row = find_row_num(ws, "id", user_id)
-    if row:
-        col = ws.find(col_name).col
-        val = ws.cell(row, col).value
-        try:
-            current_val = float(val) if val else 0.0
-        except:
-            current_val = 0.0
-        ws.update_cell(row, col, current_val + float(amount))
-        clear_cache()
+    if get_storage().increment_user_field(user_id, col_name, amount):
+        users = get_users_stable()
+        current = users.loc[users['id'].astype(str) == str(user_id), col_name]
+        try: patch_cache("users", "update", {user_id: {col_name: float(current.iloc[0]) + float(amount)}})
+        except: get_snapshots()["users"].invalidate()
 
+@api_action
 def update_user_field_direct(user_id, col_name, value):
-    sh = connect_to_gsheets()
-    ws = sh.worksheet("users")
-    row = find_row_num(ws, "id", user_id)
-    if row:
-        col = ws.find(col_name).col
-        ws.update_cell(row, col, value)
+    if get_storage().update_users({user_id: {col_name: value}}):
+        patch_cache("users", "update", {user_id: {col_name: value}})
 
+@api_action
 def delete_user_data(user_id):
-    sh = connect_to_gsheets()
-    ws_u = sh.worksheet("users")
-    row = find_row_num(ws_u, "id", user_id)
-    if row: ws_u.delete_rows(row)
-    clear_cache()
+    if get_storage().delete_user(user_id):
+        patch_cache("users", "delete", user_id)
 
 def has_record_for_date(user_id, date_str):
-    df = get_records_stable()
-    if df.empty: return False, None
-    rec = df[(df['user_id'].astype(str) == str(user_id)) & (df['date'] == date_str)]
-    if not rec.empty:
-        return True, rec.iloc[0]
+    rec = get_storage().find_record(user_id, date_str)
+    if rec is not None:
+        return True, rec
     return False, None
 
+@api_action
 def add_record(user_id, status, fine=0, note="", clock_in="", clock_out="", date_str=None):
-    sh = connect_to_gsheets()
-    ws = sh.worksheet("records")
     if date_str is None:
         now = datetime.now(JST)
         date_str = now.strftime('%Y-%m-%d')
@@ -144,52 +1464,39 @@ def add_record(user_id, status, fine=0, note="", clock_in="", clock_out="", date
         return False, "本日は既に記録が存在します"
 
     rec_id = str(uuid.uuid4())
-    ws.append_row([rec_id, user_id, date_str, clock_in, clock_out, status, fine, note])
-    clear_cache()
+    row = [rec_id, user_id, date_str, clock_in, clock_out, status, fine, note]
+    get_storage().append_records([row])
+    patch_cache("records", "append", [row])
     return True, "登録しました"
 
+@api_action
 def update_half_day_clock_in(user_id, clock_in_time_obj, fine, note_append):
-    sh = connect_to_gsheets()
-    ws = sh.worksheet("records")
     date_str = datetime.now(JST).strftime('%Y-%m-%d')
-    records = ws.get_all_records()
-    target_row_idx = -1
-    for i, r in enumerate(reversed(records)):
-        if str(r['user_id']) == str(user_id) and r['date'] == date_str:
-            real_index = (len(records) - 1) - i
-            target_row_idx = real_index + 2
-            break
-    if target_row_idx > 0:
+    record_data = get_storage().find_record(user_id, date_str)
+    if record_data:
         clock_in_str = str(clock_in_time_obj) if not isinstance(clock_in_time_obj, datetime) else clock_in_time_obj.strftime('%H:%M:%S')
-        current_note = ws.cell(target_row_idx, 8).value or ""
+        current_note = record_data['note'] or ""
         new_note = (str(current_note) + " " + note_append).strip()
-        ws.update_cell(target_row_idx, 4, clock_in_str)
-        ws.update_cell(target_row_idx, 7, fine)
-        ws.update_cell(target_row_idx, 8, new_note)
-        clear_cache()
+        fields = {"clock_in": clock_in_str, "fine": fine, "note": new_note}
+        get_storage().update_records({record_data['id']: fields})
+        patch_cache("records", "update", {record_data['id']: fields})
         return True
     return False
 
+@api_action
 def update_record_out(user_id, clock_out_obj, status, fine, note_append):
-    sh = connect_to_gsheets()
-    ws = sh.worksheet("records")
+    storage = get_storage()
     clock_out_str = str(clock_out_obj) if not isinstance(clock_out_obj, datetime) else clock_out_obj.strftime('%H:%M:%S')
-    records = ws.get_all_records()
-    target_row_idx = -1
-    record_data = None
-    for i, r in enumerate(reversed(records)):
-        if str(r['user_id']) == str(user_id) and (r['clock_out'] is None or str(r['clock_out']).strip() == ""):
-            real_index = (len(records) - 1) - i
-            target_row_idx = real_index + 2
-            record_data = r
-            break
-    if target_row_idx > 0 and record_data:
+    shifts = storage.open_shifts(user_id)
+    record_data = shifts[-1] if shifts else None
+    if record_data:
         try: clock_in_date = datetime.strptime(record_data['date'], '%Y-%m-%d').date()
         except: clock_in_date = datetime.now(JST).date()
         today_date = datetime.now(JST).date()
         early_fine = 0
         if today_date > clock_in_date:
             early_fine = 0 
+            note_append = (note_append + " (翌日退勤)").strip() # 罰金の再計算でも早退にしないための印
         else:
             status_txt = str(record_data['status'])
             is_holiday_work = "休日出勤" in status_txt or "土日祝" in str(record_data['note'])
@@ -206,52 +1513,38 @@ def update_record_out(user_id, clock_out_obj, status, fine, note_append):
         current_fine = int(record_data['fine']) if record_data['fine'] else 0
         total_fine = current_fine + early_fine
         if total_fine > MAX_DAILY_FINE: total_fine = MAX_DAILY_FINE
-        current_note = ws.cell(target_row_idx, 8).value or ""
+        current_note = record_data['note'] or ""
         new_note = (str(current_note) + " " + note_append).strip()
-        ws.update_cell(target_row_idx, 5, clock_out_str)
-        ws.update_cell(target_row_idx, 6, new_status)
-        ws.update_cell(target_row_idx, 7, total_fine)
-        ws.update_cell(target_row_idx, 8, new_note)
-        clear_cache()
+        fields = {"clock_out": clock_out_str, "status": new_status, "fine": total_fine, "note": new_note}
+        storage.update_records({record_data['id']: fields})
+        patch_cache("records", "update", {record_data['id']: fields})
         return True
     return False
 
+@api_action
 def admin_update_record_direct(rec_id, clock_in, clock_out, status, fine, note):
-    sh = connect_to_gsheets()
-    ws = sh.worksheet("records")
-    row = find_row_num(ws, "id", rec_id)
-    if row:
-        ws.update_cell(row, 4, clock_in)
-        ws.update_cell(row, 5, clock_out)
-        ws.update_cell(row, 6, status)
-        ws.update_cell(row, 7, fine)
-        ws.update_cell(row, 8, note)
-        clear_cache()
+    fields = {"clock_in": clock_in, "clock_out": clock_out, "status": status, "fine": fine, "note": note}
+    if not get_storage().update_records({rec_id: fields}): return False
+    patch_cache("records", "update", {rec_id: fields})
+    return True
 
+@api_action
 def update_initial_fine(user_id, amount):
-    sh = connect_to_gsheets()
-    ws = sh.worksheet("users")
-    row = find_row_num(ws, "id", user_id)
-    if row:
-        col = ws.find("initial_fine").col
-        ws.update_cell(row, col, amount)
-        clear_cache()
+    if get_storage().update_users({user_id: {"initial_fine": amount}}):
+        patch_cache("users", "update", {user_id: {"initial_fine": amount}})
 
+@api_action
 def update_user_name(user_id, new_name):
-    sh = connect_to_gsheets()
-    ws = sh.worksheet("users")
     current_users = get_users_stable()
     if not current_users.empty:
         exists = current_users[(current_users['name'] == new_name) & (current_users['id'].astype(str) != str(user_id))]
         if not exists.empty: return False, "その名前は既に使用されています"
-    row = find_row_num(ws, "id", user_id)
-    if row:
-        col = ws.find("name").col
-        ws.update_cell(row, col, new_name)
-        clear_cache()
+    if get_storage().update_users({user_id: {"name": new_name}}):
+        patch_cache("users", "update", {user_id: {"name": new_name}})
         return True, "名前を変更しました"
     return False, "ユーザーが見つかりません"
 
+@api_action
 def apply_leave(user_id, leave_type, target_date, cost):
     date_str = target_date.strftime('%Y-%m-%d')
     exists, _ = has_record_for_date(user_id, date_str)
@@ -263,18 +1556,18 @@ def apply_leave(user_id, leave_type, target_date, cost):
             return False, "当日の有給申請は8:00までです"
         if target_date < today:
             return False, "過去の日付での申請はできません"
-    sh = connect_to_gsheets()
-    ws = sh.worksheet("records")
     rec_id = str(uuid.uuid4())
     clk = "-" if cost >= 1.0 else ""
-    ws.append_row([rec_id, user_id, date_str, clk, clk, leave_type, 0, "申請利用"])
-    clear_cache()
+    row = [rec_id, user_id, date_str, clk, clk, leave_type, 0, "申請利用"]
+    get_storage().append_records([row])
+    patch_cache("records", "append", [row])
     return True, f"{date_str} の「{leave_type}」を登録しました"
 
+@api_action
 def register_absence(user_id):
     success, msg = add_record(user_id, "欠勤", MAX_DAILY_FINE, "手動欠勤登録")
-    if success: st.toast(f"欠勤を登録しました。(罰金{MAX_DAILY_FINE}円)")
-    else: st.error(msg)
+    if not success: st.error(msg)
+    return success
 
 def is_weekend(dt):
     return dt.weekday() >= 5
@@ -297,131 +1590,569 @@ def calculate_early_fine(check_out_dt, end_hour=WORK_END_HOUR):
     hours_early = math.ceil(diff.total_seconds() / 3600)
     return hours_early * 100
 
-def get_week_label(date_str):
-    try:
-        dt = pd.to_datetime(date_str)
-        week_num = (dt.day - 1) // 7 + 1
-        return f"{dt.strftime('%y')}.{dt.month:02}.{week_num}"
-    except: return ""
+# --- 罰金の一括計算 (列単位) ---
+LEAVE_STATUSES = ["休み", "有休", "欠勤", "特別欠勤"] # 時刻から計算しないステータス
+NEXT_DAY_MARK_SINCE = "2026-10-19" # 退勤処理が note に「(翌日退勤)」を付け始めた日 (設定 next_day_mark_since の既定値)
 
-def auto_fill_missing_days(user_id, current_rest_balance):
-    sh = connect_to_gsheets()
-    ws_r = sh.worksheet("records")
-    ws_u = sh.worksheet("users")
-    all_recs = ws_r.get_all_records()
-    user_recs = [r for r in all_recs if str(r['user_id']) == str(user_id)]
-    existing_dates = set([r['date'] for r in user_recs])
-    today = datetime.now(JST).date()
-    start_date = date(today.year, today.month, 1)
+def price_records(df):
+    """records の clock_in / clock_out / status / note の列から罰金とステータスを一括で求める。
+
+    打刻時の計算 (calculate_late_fine / calculate_early_fine と退勤処理) と同じルールで、
+      - 午前休は 13:00 始業、午後休は 13:00 終業
+      - 休日出勤 (status に「休日出勤」または note に「土日祝」) は罰金なし
+      - 遅刻+早退の合計は MAX_DAILY_FINE まで
+    を適用する。翌日以降に退勤したもの (退勤処理で note に「(翌日退勤)」を付けた分と、
+    退勤時刻が出勤時刻より前の分) は、退勤処理と同じく早退にしない。
+    「(翌日退勤)」の印は設定 next_day_mark_since (YYYY-MM-DD) 以降の日付の記録にしか付いていないので、
+    それより前の印の無い記録は翌日退勤かどうか分からない。これらは退勤時の判定 (status に「早退」が
+    あるか) をそのまま使い、早退の無かった記録を早退にしない。
+    管理者が修正したもの (note に「(管理者変更)」) は admin_update_record と同じ書式・ルール
+    (休日・翌日の扱いなし、半休は「午前休(遅刻)(早退)」の形) で求める。
+    休み・有休・欠勤や出勤時刻の無いレコードは元の値のまま返す。
+    戻り値は df と同じ index の DataFrame (fine, status)。
+    """
+    status = df['status'].fillna("").astype(str)
+    note = df['note'].fillna("").astype(str)
+    fine = pd.to_numeric(df['fine'], errors='coerce').fillna(0).astype(int)
+    t_in = pd.to_timedelta(df['clock_in'].astype(str), errors='coerce').dt.total_seconds()
+    t_out = pd.to_timedelta(df['clock_out'].astype(str), errors='coerce').dt.total_seconds()
+    is_am = status.str.contains("午前休")
+    is_pm = status.str.contains("午後休")
+    is_admin = note.str.contains("(管理者変更)", regex=False)
+    is_holiday = (status.str.contains("休日出勤") | note.str.contains("土日祝")) & ~is_admin
+    marked = note.str.contains("(翌日退勤)", regex=False)
+    legacy = (parse_dates(df['date']) < pd.Timestamp(get_setting("next_day_mark_since", NEXT_DAY_MARK_SINCE))).to_numpy()
+    next_day = ~is_admin & (marked | (t_out < t_in) | (legacy & ~status.str.contains("早退")))
+    timed = t_in.notna() & ~status.isin(LEAVE_STATUSES)
+
+    start_hour = np.where(is_am, WORK_SPLIT_HOUR, WORK_START_HOUR)
+    end_hour = np.where(is_pm, WORK_SPLIT_HOUR, WORK_END_HOUR)
+    late_hours = np.floor(t_in / 3600) - start_hour
+    late = np.where(late_hours < 0, 0, np.minimum(500 + 100 * late_hours, 1000))
+    early_sec = end_hour * 3600 - t_out
+    early = np.where(t_out.notna() & (early_sec > 0) & ~next_day, np.ceil(early_sec / 3600) * 100, 0)
+    new_fine = np.where(is_holiday, 0, np.minimum(late + early, MAX_DAILY_FINE))
+
+    # 打刻の書式: 出勤時のステータスに、退勤時に「/早退」を足す
+    base = np.where(late == 0, "通常", np.where(late >= 1000, "欠勤(遅刻超過)", "遅刻"))
+    half = np.where(is_am, "午前休", "午後休")
+    new_status = pd.Series(np.where(is_am | is_pm, half, base), index=df.index) + np.where(early > 0, "/早退", "")
+    new_status = new_status.where(~is_holiday, "休日出勤")
+    # 管理者の修正の書式
+    admin_full = np.where(late >= 1000, "欠勤(遅刻超過)", pd.Series(np.where(late == 0, "通常", "遅刻")) + np.where(early > 0, "/早退", ""))
+    admin_half = pd.Series(half) + np.where(late > 0, "(遅刻)", "") + np.where(early > 0, "(早退)", "")
+    admin_status = pd.Series(np.where(is_am | is_pm, admin_half, admin_full), index=df.index)
+    new_status = new_status.where(~is_admin, admin_status)
+
+    return pd.DataFrame({
+        'fine': fine.where(~timed, pd.Series(new_fine, index=df.index).fillna(0).astype(int)),
+        'status': status.where(~timed, new_status),
+    }, index=df.index)
+
+@api_action
+def recompute_fines(start_date, end_date, dry_run=False):
+    """期間内の全員分のレコードを現在のルールで計算し直し、変わった行だけをまとめて書き込む。
+
+    変更対象 (id, user_id, date, 変更前後の status / fine) の DataFrame を返す。dry_run なら書き込まない。
+    """
+    storage = get_storage()
+    df = storage.records_between(start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+    if df.empty: return pd.DataFrame(columns=['id', 'user_id', 'date', 'status', 'new_status', 'fine', 'new_fine'])
+    priced = price_records(df)
+    old_fine = pd.to_numeric(df['fine'], errors='coerce').fillna(0).astype(int)
+    changed = (priced['fine'] != old_fine) | (priced['status'] != df['status'].fillna("").astype(str))
+    diff = df.loc[changed, ['id', 'user_id', 'date', 'status']].assign(
+        new_status=priced.loc[changed, 'status'], fine=old_fine[changed], new_fine=priced.loc[changed, 'fine'])
+    if not dry_run and not diff.empty:
+        updates = {r.id: {"status": r.new_status, "fine": r.new_fine} for r in diff.itertuples(index=False)}
+        # 全部書けたときだけ結果をキャッシュに反映する。書けなかった id があれば読み直す
+        if storage.update_records(updates) == len(updates): patch_cache("records", "update", updates)
+        else: clear_cache()
+    return diff
+
+def parse_dates(dates):
+    """日付の列を datetime に変換する。YYYY-MM-DD 以外の書式の行だけ個別に解釈し直す"""
+    if pd.api.types.is_datetime64_any_dtype(dates): return pd.Series(dates) # 型付きの records (変換済み)
+    dates = pd.Series(dates).astype(str)
+    dt = pd.to_datetime(dates, format='%Y-%m-%d', errors='coerce')
+    retry = dt.isna() & (dates.str.strip() != "")
+    if retry.any(): dt[retry] = pd.to_datetime(dates[retry], format='mixed', errors='coerce')
+    return dt
+
+def week_labels(dates):
+    """日付の列の週ラベル (YY.MM.週番号、週番号は (日-1)//7+1、解釈できない日付は空文字)。文字列にするのは週の種類ごとに1回だけ"""
+    dt = parse_dates(dates)
+    keys = (dt.dt.year % 100 * 1000 + dt.dt.month * 10 + (dt.dt.day - 1) // 7 + 1).to_numpy()
+    codes, uniques = pd.factorize(keys)
+    labels = np.array([f"{int(k) // 1000:02}.{int(k) // 10 % 100:02}.{int(k) % 10}" for k in uniques] + [""], dtype=object)
+    return pd.Series(labels[codes], index=dt.index) # 解釈できない日付 (code -1) は末尾の ""
+
+def weekly_fine_sums(records_df):
+    """(user_id, 週) ごとの罰金合計 (sum) と件数 (count)"""
+    fine = pd.to_numeric(records_df['fine'], errors='coerce').fillna(0)
+    return fine.groupby([records_df['user_id'].to_numpy(dtype=object).astype(str), week_labels(records_df['date']).to_numpy()]).agg(['sum', 'count'])
+
+# --- 型付きの DataFrame (集計・表示用) ---
+# スナップショットは取得ごとに1回だけ型付きの DataFrame に変換して持ち、書き込みの結果 (patch) は
+# 型付きのまま重ねる (書き込みのたびに全体を変換し直さない)。全セッションで共有する (typed_snapshot は浅いコピーを返す)。
+#   records: user_id / status / clock_in / clock_out / note はカテゴリ、date は datetime64、fine は int32、
+#            in_sec / out_sec は時刻の秒 (空欄・"-" は NaN)
+#   users:   typed_frame と同じ (数値の列は数値、それ以外は文字列)
+RECORD_CATEGORY_COLS = ['user_id', 'clock_in', 'clock_out', 'status', 'note']
+TYPED_RECORD_COLS = RECORD_COLS + ['in_sec', 'out_sec']
+
+def as_category(values):
+    return pd.Series(values).fillna("").astype(str).astype('category').reset_index(drop=True)
+
+def time_seconds(clock):
+    """時刻 (カテゴリ) を秒に。文字列の解釈は種類ごとに1回だけ"""
+    seconds = pd.to_timedelta(pd.Series(clock.cat.categories, dtype=str), errors='coerce').dt.total_seconds().to_numpy(dtype='float32')
+    return np.append(seconds, np.float32('nan'))[clock.cat.codes.to_numpy()]
+
+def typed_records(df):
+    out = pd.DataFrame({'id': df['id'].astype(str).reset_index(drop=True)})
+    for col in RECORD_CATEGORY_COLS: out[col] = as_category(df[col])
+    out['date'] = parse_dates(df['date']).to_numpy()
+    out['fine'] = pd.to_numeric(df['fine'], errors='coerce').fillna(0).to_numpy().astype('int32')
+    out['in_sec'] = time_seconds(out['clock_in'])
+    out['out_sec'] = time_seconds(out['clock_out'])
+    return out
+
+def concat_typed(frames):
+    """型付きの records を連結する。カテゴリの列はカテゴリをそろえてから連結する (そろえないと object に戻る)"""
+    frames = [f for f in frames if not f.empty] or frames[:1]
+    if len(frames) == 1: return frames[0]
+    dtypes = {col: pd.CategoricalDtype(pd.api.types.union_categoricals([f[col] for f in frames], ignore_order=True).categories)
+              for col in RECORD_CATEGORY_COLS}
+    return pd.concat([f.astype(dtypes) for f in frames], ignore_index=True)
+
+def set_typed(df, pos, col, value):
+    """型付きの records の1セルを書き換える (カテゴリに無い値はカテゴリを足す)。df は呼び出し側で複製しておく"""
+    if col in RECORD_CATEGORY_COLS:
+        value = "" if value is None else str(value)
+        if value not in df[col].cat.categories: df[col] = df[col].cat.add_categories([value])
+    elif col == 'date': value = parse_dates(pd.Series([value])).iloc[0]
+    elif col == 'fine': value = pd.to_numeric(pd.Series([value]), errors='coerce').fillna(0).astype('int32').iloc[0]
+    elif col not in df: return
+    df.iat[pos, df.columns.get_loc(col)] = value
+    if col in ('clock_in', 'clock_out'):
+        seconds = pd.to_timedelta(pd.Series([value], dtype=str), errors='coerce').dt.total_seconds().iloc[0]
+        df.iat[pos, df.columns.get_loc('in_sec' if col == 'clock_in' else 'out_sec')] = np.float32(seconds)
+
+def apply_typed_journal(df, entries):
+    """apply_journal の型付きの records 版。追加行だけを変換して連結し、更新は該当のセルだけを書き換える"""
+    for _, _, kind, payload in entries:
+        if kind == "append":
+            found = id_positions(df, [r[0] for r in payload])
+            new = [r for r, pos in zip(payload, found) if pos < 0]
+            if new: df = concat_typed([df, typed_records(pd.DataFrame(new, columns=RECORD_COLS))])
+        elif kind == "update":
+            targets = [(pos, fields) for pos, fields in zip(id_positions(df, payload), payload.values()) if pos >= 0]
+            if not targets: continue
+            df = df.copy(deep=False) # Copy-on-Write: 書き換えた列だけが複製される
+            for pos, fields in targets:
+                for col, value in fields.items(): set_typed(df, pos, col, value)
+        elif kind == "delete":
+            df = df[df['id'].astype(str) != payload].reset_index(drop=True)
+    return df
+
+def typed_snapshot(name):
+    """(型付きの DataFrame, 版)。返すのは浅いコピー
+    (Copy-on-Write なので、呼び出し側で列を書き換えても共有の DataFrame は変わらない)"""
+    df, version = get_snapshots()[name].versioned()
+    return df.copy(deep=False), version
+
+def changed_rows(a, b):
+    """同じ列・同じ行数の2つの DataFrame で、値が違う行 (NaT 同士・カテゴリの種類の違いは値で比べる)"""
+    changed = np.zeros(len(a), dtype=bool)
+    for col in a.columns:
+        x, y = a[col], b[col]
+        if isinstance(x.dtype, pd.CategoricalDtype) or isinstance(y.dtype, pd.CategoricalDtype):
+            x, y = x.to_numpy(dtype=object), y.to_numpy(dtype=object)
+        else:
+            x, y = x.to_numpy(), y.to_numpy()
+            if x.dtype.kind == 'M' and y.dtype.kind == 'M': x, y = x.view('i8'), y.view('i8')
+        changed |= x != y
+    return changed
+
+# --- 週別・累計リスト (集計結果の保持) ---
+class WeeklyFineView:
+    """週別の罰金集計を records の版ごとに保持する。
+
+    アーカイブ (先月以前) と records シートは別々に集計して足し合わせる。それぞれ版が変わったときは
+    前回集計した行と比べ、書き換わった行と末尾に追加された行の分だけ合計を差し引き・足し込みする。
+    行が減った (削除・月の切り替え) ときだけ全件を集計し直す。
+    表示用の表は users と各 records の版の組が変わらない限り作り直さない。
+    """
+    KEY_COLS = ['user_id', 'date', 'fine']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.parts = {} # 名前 -> (版, 前回集計した行 (KEY_COLS のみ), 合計)
+        self.table_key = None
+        self.cached_table = None
+
+    def refresh(self, name, records_df, version):
+        prev_version, source, sums = self.parts.get(name, (None, None, None))
+        if version == prev_version: return sums
+        keys = records_df[self.KEY_COLS].reset_index(drop=True)
+        n = 0 if source is None else len(source)
+        if n and len(keys) >= n:
+            changed = changed_rows(keys.iloc[:n], source)
+            added = pd.concat([keys.iloc[:n][changed], keys.iloc[n:]])
+            sums = sums.sub(weekly_fine_sums(source[changed]), fill_value=0)
+            sums = sums.add(weekly_fine_sums(added), fill_value=0)
+            sums = sums[sums['count'] > 0] # 別の週へ移った行の分は消す
+        else:
+            sums = weekly_fine_sums(keys)
+        self.parts[name] = (version, keys, sums)
+        return sums
+
+    def table(self, users, users_version, parts):
+        """parts: {名前: (records の DataFrame, 版)}"""
+        with self.lock:
+            key = (users_version,) + tuple((name, version) for name, (_, version) in sorted(parts.items()))
+            if key == self.table_key: return self.cached_table
+            sums = None
+            for name, (records_df, version) in parts.items():
+                part = self.refresh(name, records_df, version)['sum']
+                sums = part if sums is None else sums.add(part, fill_value=0)
+            names = dict(zip(users['id'], users['name']))
+            pivot = sums[sums.index.get_level_values(0).isin(list(names))]
+            if pivot.empty: pivot = pd.DataFrame()
+            else:
+                pivot = pivot.groupby([pivot.index.get_level_values(0).map(names), pivot.index.get_level_values(1)]).sum().unstack(fill_value=0)
+            u_init = users[['name', 'initial_fine']].set_index('name')
+            pivot = pivot.join(u_init, how='outer').fillna(0)
+            pivot = pivot.rename(columns={'initial_fine': '運用前罰金'})
+            pivot['Total'] = pivot.sum(axis=1)
+            cols = sorted(c for c in pivot.columns if c not in ['運用前罰金', 'Total'])
+            self.table_key, self.cached_table = key, pivot[['運用前罰金'] + cols + ['Total']]
+            return self.cached_table
+
+class ViewCache:
+    """集計結果のキャッシュ。キー (集計の種類と条件) ごとに最新の版の結果だけを持つ。
+
+    元データの版が変わったら作り直して置き換えるので、古い版の結果 (全件の連結など) は残らない。
+    キーの数は max_entries まで (使われていないものから捨てる)。
+    """
+    def __init__(self, max_entries=64):
+        self.lock = threading.Lock()
+        self.items = OrderedDict() # キー -> (版, 結果)
+        self.max_entries = max_entries
+
+    def get(self, key, version, build):
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None and item[0] == version:
+                self.items.move_to_end(key)
+                return item[1]
+        value = build()
+        with self.lock:
+            self.items[key] = (version, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_entries: self.items.popitem(last=False)
+        return value
+
+@st.cache_resource
+def get_views():
+    return {"weekly_fines": WeeklyFineView(), "memo": ViewCache()}
+
+def weekly_fine_table():
+    users, users_version = typed_snapshot("users")
+    parts = {name: typed_snapshot(name) for name in ("archive", "records")}
+    return get_views()["weekly_fines"].table(users, users_version, parts)
+
+def all_records():
+    """アーカイブ + records シートの全件 (型付き)。両方の版が変わらない限り連結し直さない"""
+    archive, archive_version = typed_snapshot("archive")
+    records, records_version = typed_snapshot("records")
+    if archive.empty: return records
+    return get_views()["memo"].get("all_records", (archive_version, records_version), lambda: concat_typed([archive, records])).copy(deep=False)
+
+# --- 全ログの索引 ---
+class LogIndex:
+    """全ログ用に (date, user_id) の順で並べた索引。
+
+    日付の範囲は二分探索で絞り、担当者・状態はその範囲の中だけを調べる。
+    DataFrame にするのは表示するページの行だけ。
+    """
+    def __init__(self, records_df):
+        self.df = records_df # 型付きの records
+        dates = records_df['date'].to_numpy(dtype='datetime64[ns]').view('i8') # 解釈できない日付 (NaT) は先頭に並ぶ
+        user_kinds = records_df['user_id'].cat.categories.astype(str)
+        user_rank = np.argsort(np.argsort(user_kinds.to_numpy())) # カテゴリの順ではなく user_id の文字列順に並べる
+        users = user_rank[records_df['user_id'].cat.codes.to_numpy()]
+        # 同じ (date, user) の中は追加順
+        self.order = np.lexsort((users, dates))
+        self.dates = dates[self.order]
+        self.user_codes = records_df['user_id'].cat.codes.to_numpy()[self.order]
+        self.user_kinds = user_kinds
+        self.status_codes = records_df['status'].cat.codes.to_numpy()[self.order]
+        self.status_kinds = records_df['status'].cat.categories.astype(str)
+
+    def query(self, user_id=None, start=None, end=None, status=""):
+        """条件に合う行の位置 (新しい順)。start / end は YYYY-MM-DD、status は部分一致"""
+        day = lambda s: pd.Timestamp(s).as_unit('ns').value
+        if start: lo = np.searchsorted(self.dates, day(start), 'left')
+        else: lo = np.searchsorted(self.dates, np.iinfo('i8').min, 'right') if end else 0 # 期間を指定したときは日付のない行を除く
+        hi = np.searchsorted(self.dates, day(end), 'right') if end else len(self.dates)
+        mask = np.ones(max(hi - lo, 0), dtype=bool)
+        if user_id is not None: mask &= np.isin(self.user_codes[lo:hi], np.flatnonzero(self.user_kinds == str(user_id)))
+        if status:
+            hit = np.asarray(self.status_kinds.str.contains(status, regex=False))
+            mask &= hit[self.status_codes[lo:hi]]
+        return self.order[lo:hi][mask][::-1]
+
+    def find(self, user_id, date):
+        """その日のその人の行の位置 (無ければ None)。同じ日の行が複数あるときは最初に追加した行"""
+        positions = self.query(user_id, date, date)
+        return positions[-1] if len(positions) else None
+
+    def page(self, positions, page, page_size):
+        rows = self.df.iloc[positions[(page - 1) * page_size:page * page_size]]
+        return rows.assign(date=rows['date'].dt.strftime('%Y-%m-%d').fillna(""))
+
+def log_index():
+    snapshots = get_snapshots()
+    version = (snapshots["archive"].version, snapshots["records"].version) # 版を先に読む (versioned() と同じ)
+    return get_views()["memo"].get("log_index", version, lambda: LogIndex(all_records()))
+
+# --- 休暇の使用回数 ---
+def count_leave_usage(records_df):
+    """user_id ごとの 休み系 (休み/午前休/午後休) と 有休 の件数。status の種類 (カテゴリ) ごとに1回だけ判定する"""
+    codes, kinds = records_df['status'].cat.codes.to_numpy(), pd.Series(records_df['status'].cat.categories, dtype=str)
+    usage = pd.DataFrame({'rest_used': kinds.str.contains('休み|午前休|午後休').to_numpy()[codes].astype(int),
+                          'paid_used': kinds.str.contains('有休').to_numpy()[codes].astype(int)})
+    return usage.groupby(records_df['user_id'].to_numpy(dtype=object)).sum()
+
+def leave_usage_summary():
+    """休暇の使用回数 (index: user_id, 列: rest_used / paid_used)。records の版ごとに1回だけ集計し、各タブで共用する"""
+    memo = get_views()["memo"]
+    parts = {name: typed_snapshot(name) for name in ("archive", "records")}
+    # アーカイブ分は版が変わらない限り数え直さない
+    count = lambda name: memo.get(("leave_usage", name), parts[name][1], lambda: count_leave_usage(parts[name][0]))
+    return memo.get("leave_usage", (parts["archive"][1], parts["records"][1]),
+                    lambda: count("archive").add(count("records"), fill_value=0).astype(int))
+
+def plan_missing_days(user_id, current_rest_balance, existing_dates, today):
+    """月初から昨日までの未登録の平日を埋める行を作る。(追加行, ログ, 新しい休み残) を返す"""
     temp_rest_balance = float(current_rest_balance)
-    fill_log = []
-    check_date = start_date
+    rows, fill_log = [], []
+    check_date = date(today.year, today.month, 1)
     while check_date < today:
         date_s = check_date.strftime('%Y-%m-%d')
         if not is_weekend(check_date) and date_s not in existing_dates:
             rec_id = str(uuid.uuid4())
             if temp_rest_balance >= 1.0:
-                ws_r.append_row([rec_id, user_id, date_s, "", "", "休み", 0, "自動適用"])
+                rows.append([rec_id, user_id, date_s, "", "", "休み", 0, "自動適用"])
                 temp_rest_balance -= 1.0
                 fill_log.append(f"{date_s}: 休み(残消化)")
             else:
-                ws_r.append_row([rec_id, user_id, date_s, "", "", "欠勤", 1000, "自動適用"])
+                rows.append([rec_id, user_id, date_s, "", "", "欠勤", 1000, "自動適用"])
                 fill_log.append(f"{date_s}: 欠勤(¥1000)")
         check_date += timedelta(days=1)
-    if temp_rest_balance != current_rest_balance:
-        row = find_row_num(ws_u, "id", user_id)
-        col = ws_u.find("rest_balance").col
-        ws_u.update_cell(row, col, temp_rest_balance)
-    if fill_log:
-        clear_cache()
-        return fill_log
-    return []
+    return rows, fill_log, temp_rest_balance
+
+@api_action
+def auto_fill_missing_days_bulk(rest_balances):
+    """{user_id: 休み残} の全員分をまとめて埋める。
+
+    既存の日付は今月分の records だけから求め、追加行は1回の append_records、
+    休み残の更新は1回の update_users で書き込む。戻り値は {user_id: ログ}。
+
+    追加行と休み残を1回の values_batch_update にまとめないのは、行番号を指定して書くと
+    他のプロセスが同時に追加した行を上書きしうるため (append_rows はシートの末尾に追加する)。
+    行を先に書くので、休み残の更新だけが失敗しても再実行で行が二重に追加されることはない。
+    """
+    storage = get_storage()
+    today = datetime.now(JST).date()
+    df_m = storage.records_between(today.strftime('%Y-%m-01'), today.strftime('%Y-%m-%d'))
+    existing = {}
+    if not df_m.empty:
+        existing = df_m.groupby(df_m['user_id'].astype(str))['date'].agg(lambda s: set(s.astype(str))).to_dict()
+    all_rows, logs, new_balances = [], {}, {}
+    for user_id, current_rest_balance in rest_balances.items():
+        rows, fill_log, temp_rest_balance = plan_missing_days(user_id, current_rest_balance, existing.get(str(user_id), set()), today)
+        if not rows: continue
+        all_rows += rows
+        logs[user_id] = fill_log
+        if temp_rest_balance != current_rest_balance: new_balances[user_id] = temp_rest_balance
+    if not all_rows: return {}
+    storage.append_records(all_rows)
+    patch_cache("records", "append", all_rows)
+    if new_balances:
+        updates = {user_id: {"rest_balance": bal} for user_id, bal in new_balances.items()}
+        storage.update_users(updates)
+        patch_cache("users", "update", updates)
+    return logs
+
+@api_action
+def auto_fill_missing_days(user_id, current_rest_balance):
+    return auto_fill_missing_days_bulk({user_id: current_rest_balance}).get(user_id, [])
 
+@api_action
+def auto_fill_missing_days_all():
+    """全員分の未登録日をまとめて埋める"""
+    users = get_storage().load_users() # 直前の付与などを反映した最新の残数を使う
+    balances = {}
+    for _, u in users.iterrows():
+        try: balances[str(u['id'])] = float(u['rest_balance'])
+        except: balances[str(u['id'])] = 0.0
+    return auto_fill_missing_days_bulk(balances)
+
+@api_action
+def force_checkout(now=None):
+    """前日以前 (23:55 を過ぎたら当日も) の未退勤レコードを 23:55 で締め、締めた件数を返す"""
+    storage = get_storage()
+    now_dt = now or datetime.now(JST)
+    today_str = now_dt.strftime('%Y-%m-%d')
+    force_time_str = "23:55:00"
+    updated_count = 0
+    closed = {}
+    for r in storage.open_shifts():
+        rec_date_str = str(r['date'])
+        should_close = False
+        if rec_date_str < today_str: should_close = True
+        elif rec_date_str == today_str and (now_dt.hour == 23 and now_dt.minute >= 55): should_close = True
+        if should_close:
+            closed[r['id']] = {"clock_out": force_time_str, "note": (str(r['note'] or "") + " (強制退勤)").strip()}
+    if closed:
+        updated_count = storage.update_records(closed)
+        patch_cache("records", "update", closed)
+    return updated_count
+
+@api_action
 def auto_force_checkout():
+    """画面の表示ごとの強制退勤 (設定 maintenance が "page" のときだけ)。セッションごとに60秒に1回まで"""
     if 'last_force_checkout' in st.session_state:
         if (datetime.now(JST) - st.session_state.last_force_checkout).total_seconds() < 60: return
     try:
-        sh = connect_to_gsheets()
-        ws = sh.worksheet("records")
-        records = ws.get_all_records()
-        now_dt = datetime.now(JST)
-        today_str = now_dt.strftime('%Y-%m-%d')
-        force_time_str = "23:55:00"
-        updated_count = 0
-        for i, r in enumerate(records):
-            if r['clock_out'] is None or str(r['clock_out']).strip() == "":
-                rec_date_str = r['date']
-                should_close = False
-                if rec_date_str < today_str: should_close = True
-                elif rec_date_str == today_str and (now_dt.hour == 23 and now_dt.minute >= 55): should_close = True
-                if should_close:
-                    row_idx = i + 2
-                    new_note = (str(r['note'] or "") + " (強制退勤)").strip()
-                    ws.update_cell(row_idx, 5, force_time_str)
-                    ws.update_cell(row_idx, 8, new_note)
-                    updated_count += 1
+        updated_count = force_checkout()
         if updated_count > 0: st.toast(f"{updated_count}件の未退勤レコードを23:55で締めました")
-        st.session_state.last_force_checkout = now_dt
-    except Exception: pass
+        st.session_state.last_force_checkout = datetime.now(JST)
+    except Exception as e: get_metrics().error(e)
+
+def maintenance_in_page():
+    """定期処理 (付与・強制退勤・未登録日の自動登録) を画面の表示ごとに行うか。
+    既定の "jobs" では jobs.py (cron / systemd timer から実行) に任せ、画面では何もしない"""
+    return get_setting("maintenance", "jobs") == "page"
+
+# --- 定期付与 (毎週月曜 休み+1.0 / 毎月1日 有給+2.0) ---
+@st.cache_resource
+def get_grant_state():
+    # done: このプロセスで付与を済ませた期間 ("week", "2026-41") など
+    return {"lock": threading.Lock(), "done": set()}
+
+def compute_due_grants(users_df, now):
+    """全員分の付与を1回の列演算で求める。({user_id: 更新内容}, 通知メッセージ) を返す
+
+    last_reset_week / last_reset_month が今期のユーザーは対象外なので、何度呼んでも二重付与にならない。
+    """
+    cur_week = now.strftime("%Y-%W")
+    cur_month = now.strftime("%Y-%m")
+    ids = users_df['id'].astype(str)
+    rest = pd.to_numeric(users_df['rest_balance'], errors='coerce').fillna(0.0)
+    paid = pd.to_numeric(users_df['paid_leave_balance'], errors='coerce').fillna(0.0)
+    week_due = (users_df['last_reset_week'].astype(str) != cur_week) & (now.weekday() == 0)
+    month_due = (users_df['last_reset_month'].astype(str) != cur_month) & (now.day == 1)
+    updates = {}
+    for uid, bal in zip(ids[week_due], rest[week_due] + 1.0):
+        updates.setdefault(uid, {}).update({"rest_balance": bal, "last_reset_week": cur_week})
+    for uid, bal in zip(ids[month_due], paid[month_due] + 2.0):
+        updates.setdefault(uid, {}).update({"paid_leave_balance": bal, "last_reset_month": cur_month})
+    messages = [f"月曜日: {n}さんの休みリセット" for n in users_df.loc[week_due, 'name']]
+    messages += [f"月初: {n}さんの有給リセット" for n in users_df.loc[month_due, 'name']]
+    return updates, messages
+
+@api_action
+def grant_periodic_leave(now=None):
+    """期限の来た週次・月次付与を全員分まとめて書き込み、通知メッセージを返す。
+
+    プロセス内ではロックと付与済み期間で1回にまとめ、付与前にシートを読み直して last_reset_* を確認する。
+    読んでから書くまでの間に他のプロセスが付与すると二重付与になるので、呼び出し側で
+    job_lock (jobs.py と同じロックファイル) を取ってから呼ぶ。ロックは同じマシンの中だけで有効。
+    """
+    now = now or datetime.now(JST)
+    periods = []
+    if now.weekday() == 0: periods.append(("week", now.strftime("%Y-%W")))
+    if now.day == 1: periods.append(("month", now.strftime("%Y-%m")))
+    state = get_grant_state()
+    with state["lock"]:
+        if all(p in state["done"] for p in periods): return []
+        storage = get_storage()
+        users_df = storage.load_users()
+        messages = []
+        if not users_df.empty:
+            updates, messages = compute_due_grants(users_df, now)
+            if updates:
+                storage.update_users(updates)
+                patch_cache("users", "update", updates)
+        state["done"].update(periods)
+    return messages
+
+def job_lock(path=None):
+    """定期処理のロックファイル (設定 job_lock_path、既定 jobs.lock) を flock で排他に開く。
+    他のプロセスが持っていれば None (待たない)。閉じると外れる"""
+    f = open(path or get_setting("job_lock_path", "jobs.lock"), "a+")
+    try: fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
 
+@api_action
 def run_global_auto_grant():
-    if 'last_check' in st.session_state:
-        if (datetime.now(JST) - st.session_state.last_check).total_seconds() < 60: return
     try:
-        users_df = get_users_stable()
-        today = datetime.now(JST)
-        cur_week = today.strftime("%Y-%W")
-        cur_month = today.strftime("%Y-%m")
-        updates = False
-        for index, u in users_df.iterrows():
-            uid = str(u['id'])
-            last_w = str(u['last_reset_week'])
-            last_m = str(u['last_reset_month'])
-            try: r_bal = float(u['rest_balance'])
-            except: r_bal = 0.0
-            try: p_bal = float(u['paid_leave_balance'])
-            except: p_bal = 0.0
-            
-            if today.weekday() == 0 and last_w != cur_week:
-                update_user_field_direct(uid, "rest_balance", r_bal + 1.0)
-                update_user_field_direct(uid, "last_reset_week", cur_week)
-                st.toast(f"月曜日: {u['name']}さんの休みリセット")
-                updates = True
-            if today.day == 1 and last_m != cur_month:
-                update_user_field_direct(uid, "paid_leave_balance", p_bal + 2.0)
-                update_user_field_direct(uid, "last_reset_month", cur_month)
-                st.toast(f"月初: {u['name']}さんの有給リセット")
-                updates = True
-        if updates: clear_cache()
-        st.session_state.last_check = datetime.now(JST)
-    except Exception: pass
+        lock = job_lock()
+        if lock is None: return # jobs.py か他の画面のプロセスが実行中。次の表示でやり直す
+        with lock:
+            for msg in grant_periodic_leave(): st.toast(msg)
+    except Exception as e: get_metrics().error(e)
 
+@api_action
 def admin_force_grant_all(grant_type):
-    sh = connect_to_gsheets()
-    ws = sh.worksheet("users")
-    users = ws.get_all_records()
+    storage = get_storage()
+    users = storage.load_users()
     today = datetime.now(JST)
     cur_week = today.strftime("%Y-%W")
     cur_month = today.strftime("%Y-%m")
-    count = 0
-    for i, u in enumerate(users):
-        row = i + 2 
+    updates = {}
+    for uid in users['id'].astype(str):
         if grant_type == "rest":
-            col_bal = ws.find("rest_balance").col
-            col_last = ws.find("last_reset_week").col
-            ws.update_cell(row, col_bal, 1.0) # 1.0にリセット
-            ws.update_cell(row, col_last, cur_week)
-            count += 1
+            updates[uid] = {"rest_balance": 1.0, "last_reset_week": cur_week} # 1.0にリセット
         elif grant_type == "paid":
-            col_bal = ws.find("paid_leave_balance").col
-            col_last = ws.find("last_reset_month").col
-            ws.update_cell(row, col_bal, 2.0)
-            ws.update_cell(row, col_last, cur_month)
-            count += 1
-    clear_cache()
+            updates[uid] = {"paid_leave_balance": 2.0, "last_reset_month": cur_month}
+    count = storage.update_users(updates) if updates else 0
+    if count: patch_cache("users", "update", updates)
     return f"{count}名のデータをリセットしました。"
 
+@api_action
+def export_to_sheets():
+    """ローカルの保存先の内容をスプレッドシートへ丸ごと書き出す"""
+    storage = get_storage()
+    users, records = storage.load_users(), pd.concat([storage.load_archive(), storage.load_records()], ignore_index=True)
+    SheetsStorage().replace_all(users, records)
+    return f"ユーザー{len(users)}名・記録{len(records)}件を書き出しました。"
+
+@api_action
+def import_from_sheets():
+    """スプレッドシートの内容でローカルの保存先を置き換える"""
+    sheets = SheetsStorage()
+    users, records = sheets.load_users(), pd.concat([sheets.load_archive(), sheets.load_records()], ignore_index=True)
+    get_storage().replace_all(users, records)
+    clear_cache()
+    return f"ユーザー{len(users)}名・記録{len(records)}件を取り込みました。"
+
+@api_action
+def rollover_records(now=None):
+    """先月以前の records を月別のアーカイブシートへ移す。{月: 移した件数} を返す"""
+    moved = get_storage().rollover(now)
+    if moved: clear_cache()
+    return moved
+
 # ★修正: 管理者権限での半休・全休変更ロジックを追加
+@api_action
 def admin_update_record(record_id, edit_date, new_in_t, new_out_t, new_note, mode_override):
     msg_type = "success"
     msg = ""
@@ -486,27 +2217,27 @@ def admin_update_record(record_id, edit_date, new_in_t, new_out_t, new_note, mod
     if "(管理者変更)" not in new_note:
         new_note = (new_note + " (管理者変更)").strip()
 
-    admin_update_record_direct(record_id, in_str, out_str, status, total_fine, new_note)
+    if not admin_update_record_direct(record_id, in_str, out_str, status, total_fine, new_note):
+        return "記録が見つからないため修正できませんでした", "error"
     msg = f"修正完了: {status} (罰金:{total_fine}円)"
     
     return msg, msg_type
 
-def generate_calendar_html(year, month, df_data, user_name):
-    cal = calendar.Calendar(firstweekday=6) 
-    month_days = cal.monthdayscalendar(year, month)
-    html = f"""
+CALENDAR_STYLE = """
     <style>
-        .calendar-container {{ width: 100%; overflow-x: auto; }}
-        .calendar-table {{ width: 100%; min_width: 600px; border-collapse: collapse; table-layout: fixed; }}
-        .calendar-table th {{ background-color: #f0f2f6; color: #31333F; border: 1px solid #e0e0e0; padding: 8px; text-align: center; font-weight: bold; }}
-        .calendar-table td {{ border: 1px solid #e0e0e0; vertical-align: top; padding: 5px; height: 80px; background-color: #ffffff; }}
-        .date-num {{ font-weight: bold; margin-bottom: 5px; color: #555; }}
-        .event-box {{ font-size: 0.85em; padding: 2px 4px; margin-bottom: 2px; border-radius: 4px; background-color: #f8f9fa; border-left: 3px solid #ccc; }}
-        .event-fine {{ background-color: #ffebee; border-left: 3px solid #ff4b4b; color: #a00; }}
-        .event-ok {{ border-left: 3px solid #00c853; color: #007029; }}
-        .event-rest {{ border-left: 3px solid #2962ff; color: #0039cb; }}
-        .empty-day {{ background-color: #f9f9f9; }}
+        .calendar-container { width: 100%; overflow-x: auto; }
+        .calendar-table { width: 100%; min_width: 600px; border-collapse: collapse; table-layout: fixed; }
+        .calendar-table th { background-color: #f0f2f6; color: #31333F; border: 1px solid #e0e0e0; padding: 8px; text-align: center; font-weight: bold; }
+        .calendar-table td { border: 1px solid #e0e0e0; vertical-align: top; padding: 5px; height: 80px; background-color: #ffffff; }
+        .date-num { font-weight: bold; margin-bottom: 5px; color: #555; }
+        .event-box { font-size: 0.85em; padding: 2px 4px; margin-bottom: 2px; border-radius: 4px; background-color: #f8f9fa; border-left: 3px solid #ccc; }
+        .event-fine { background-color: #ffebee; border-left: 3px solid #ff4b4b; color: #a00; }
+        .event-ok { border-left: 3px solid #00c853; color: #007029; }
+        .event-rest { border-left: 3px solid #2962ff; color: #0039cb; }
+        .empty-day { background-color: #f9f9f9; }
     </style>
+"""
+CALENDAR_HEAD = """
     <div class="calendar-container">
         <table class="calendar-table">
             <thead>
@@ -514,52 +2245,452 @@ def generate_calendar_html(year, month, df_data, user_name):
             </thead>
             <tbody>
     """
-    for week in month_days:
+
+def calendar_event_html(fine, status):
+    if fine > 0: return f"<div class='event-box event-fine'>¥{fine:,}<br>{status}</div>"
+    if "休" in status: return f"<div class='event-box event-rest'>{status}</div>"
+    return f"<div class='event-box event-ok'>{status}</div>"
+
+def generate_calendar_html(year, month, df_data, user_name):
+    # 月のレコードを日ごとに1回で振り分けてから組み立てる
+    events = {}
+    for day, fine, status in zip(df_data['date_dt'].dt.day, df_data['fine'], df_data['status']):
+        events.setdefault(day, []).append(calendar_event_html(int(fine), str(status)))
+    parts = [CALENDAR_STYLE, CALENDAR_HEAD]
+    for week in calendar.Calendar(firstweekday=6).monthdayscalendar(year, month):
         if sum(week) == 0: continue
-        html += "<tr>"
+        parts.append("<tr>")
         for day in week:
-            if day == 0: html += "<td class='empty-day'></td>"
-            else:
-                day_rec = df_data[df_data['date_dt'].dt.day == day]
-                cell_content = f"<div class='date-num'>{day}</div>"
-                if not day_rec.empty:
-                    for _, r in day_rec.iterrows():
-                        fine = int(r['fine'])
-                        status = r['status']
-                        if fine > 0:
-                            css_class = "event-fine"
-                            text = f"¥{fine:,}<br>{status}"
-                        elif "休み" in status or "休" in status:
-                            css_class = "event-rest"
-                            text = status
+            if day == 0: parts.append("<td class='empty-day'></td>")
+            else: parts.append(f"<td><div class='date-num'>{day}</div>{''.join(events.get(day, []))}</td>")
+        parts.append("</tr>")
+    parts.append("</tbody></table></div>")
+    return "".join(parts)
+
+def month_records(records_df, user_id, year, month):
+    """1人分・1か月分のレコード (型付きの records に date_dt を付けたもの)"""
+    start = pd.Timestamp(int(year), int(month), 1)
+    dates = records_df['date']
+    df_m = records_df[(records_df['user_id'] == str(user_id)).to_numpy() & (dates >= start).to_numpy() & (dates < start + pd.DateOffset(months=1)).to_numpy()]
+    return df_m.assign(date_dt=df_m['date'])
+
+def fine_calendar(user_id, year, month, user_name):
+    """(カレンダーの HTML, 月の罰金合計)。(user, 年, 月, records の版) ごとにキャッシュする"""
+    archive, archive_version = typed_snapshot("archive")
+    records, records_version = typed_snapshot("records")
+    version = (archive_version, records_version)
+    def build():
+        df_m = concat_typed([month_records(archive, user_id, year, month), month_records(records, user_id, year, month)])
+        return generate_calendar_html(year, month, df_m, user_name), int(df_m['fine'].sum())
+    return get_views()["memo"].get(("calendar", str(user_id), int(year), int(month)), version, build)
+
+# --- 画面 (タブごとに描画する) ---
+# 全体の再実行 ("app") か、タブの中の操作によるそのタブだけの再実行 ("fragment") か
+RENDER_SCOPE = context_var("render_scope", "fragment")
+
+class RenderCosts:
+    """タブごとの描画時間を記録する (再実行の内訳の確認用)"""
+    def __init__(self, max_events=5000):
+        self.lock = threading.Lock()
+        self.events = deque(maxlen=max_events)
+
+    def record(self, section, ms):
+        with self.lock: self.events.append((t.time(), section, RENDER_SCOPE.get(), ms))
+
+    def summary(self, since=0.0):
+        with self.lock: df = pd.DataFrame([e for e in self.events if e[0] >= since], columns=['ts', 'section', 'scope', 'ms'])
+        if df.empty: return df
+        g = df.groupby(['section', 'scope'])['ms']
+        return pd.DataFrame({'runs': g.size(), 'last_ms': g.last(), 'p50_ms': g.median(), 'p95_ms': g.quantile(0.95)}).reset_index()
+
+@st.cache_resource
+def get_render_costs():
+    return RenderCosts()
+
+def tab_fragment(func):
+    """タブの中身を fragment にし (中の操作ではそのタブだけを再実行する)、描画時間を記録する"""
+    @st.fragment
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = t.perf_counter()
+        try: return func(*args, **kwargs)
+        finally: get_render_costs().record(func.__name__, (t.perf_counter() - started) * 1000)
+    return wrapper
+
+def notify_and_rerun(message):
+    """打刻の結果を再実行後の toast で知らせる (結果を見せるために待たない)"""
+    st.session_state.notice = message
+    st.rerun()
+
+def user_name_map(users):
+    """名前 -> id (文字列)"""
+    return dict(zip(users['name'], users['id']))
+
+@tab_fragment
+def tab_punch(selected_user_name):
+    """「打刻・申請」タブ"""
+    users = get_users_typed()
+    user_names = user_name_map(users)
+    if selected_user_name != "(選択してください)":
+        user_id = user_names[selected_user_name]
+        u_row = users[users['id'] == user_id].iloc[0]
+        st.write(f"### {selected_user_name} さんの操作")
+        col1, col2 = st.columns([1, 1])
+        with col1:
+            st.info(f"現在: {datetime.now(JST).strftime('%m/%d %H:%M')}")
+            is_holiday = is_weekend(datetime.now(JST))
+            holiday_chk = st.checkbox("祝日・休日出勤 (罰金なし)", value=is_holiday)
+            
+            if st.button("出勤 🟢", type="primary", width="stretch"):
+                now = datetime.now(JST)
+                date_str = now.strftime('%Y-%m-%d')
+                exists, rec = has_record_for_date(user_id, date_str)
+                
+                if exists:
+                    status_val = str(rec['status'])
+                    if "午前休" in status_val:
+                        fine, _ = calculate_late_fine(now, start_hour=WORK_SPLIT_HOUR)
+                        if fine > MAX_DAILY_FINE: fine = MAX_DAILY_FINE
+                        update_half_day_clock_in(user_id, now, fine, "(午前休出勤)")
+                        notify_and_rerun("出勤しました(午前休)")
+                    elif "午後休" in status_val:
+                        fine, _ = calculate_late_fine(now, start_hour=WORK_START_HOUR)
+                        if fine > MAX_DAILY_FINE: fine = MAX_DAILY_FINE
+                        update_half_day_clock_in(user_id, now, fine, "(午後休出勤)")
+                        notify_and_rerun("出勤しました(午後休)")
+                    else:
+                        st.error("本日は既に記録が存在します")
+                else:
+                    fine, status = 0, "休日出勤"
+                    if not (is_holiday or holiday_chk): fine, status = calculate_late_fine(now)
+                    if fine > MAX_DAILY_FINE: fine = MAX_DAILY_FINE
+                    success, msg = add_record(user_id, status, fine, clock_in=now.strftime('%H:%M:%S'), note="土日祝" if (is_holiday or holiday_chk) else "")
+                    if success: notify_and_rerun(f"出勤しました ({status})")
+                    else: st.error(msg)
+
+            with st.form(key="clock_out_form", clear_on_submit=True):
+                note = st.text_input("退勤備考")
+                if st.form_submit_button("退勤 🔴", width="stretch"):
+                    now = datetime.now(JST)
+                    early_fine = 0
+                    if update_record_out(user_id, now, "退勤済", 0, note):
+                        notify_and_rerun("退勤しました")
+                    else: st.error("出勤記録が見つかりません")
+        with col2:
+            try: rest_b = float(u_row['rest_balance'])
+            except: rest_b = 0.0
+            try: paid_b = float(u_row['paid_leave_balance'])
+            except: paid_b = 0.0
+            st.markdown(f"""
+            <div style="background-color:#f0f2f6; padding:10px; border-radius:5px; margin-bottom:10px;">
+                <strong>現在の残数:</strong> 休 <span style="font-size:1.2em; color:blue;">{rest_b:.1f}</span> / 有 <span style="font-size:1.2em; color:green;">{paid_b:.1f}</span>
+            </div>""", unsafe_allow_html=True)
+            
+            with st.form(key="leave_form", clear_on_submit=True):
+                t_date = st.date_input("日付", value=datetime.now(JST))
+                leave_option = st.selectbox("種類を選択", ["休み(全日) -1.0", "午前休(9-13時休み) -0.5", "午後休(13-15時休み) -0.5", "有給(全日) -1.0"])
+                
+                submitted = st.form_submit_button("申請・使用")
+                
+                if submitted:
+                    cost = 1.0
+                    l_type = "休み"
+                    target_bal = "rest_balance"
+                    if "午前休" in leave_option: cost = 0.5; l_type = "午前休"
+                    elif "午後休" in leave_option: cost = 0.5; l_type = "午後休"
+                    elif "有給" in leave_option: l_type = "有休"; target_bal = "paid_leave_balance"
+                    
+                    try: current_bal = float(u_row[target_bal])
+                    except: current_bal = 0.0
+                    
+                    if current_bal >= cost:
+                        success, msg = apply_leave(user_id, l_type, t_date, cost)
+                        if success:
+                            update_user_balance(user_id, target_bal, -cost)
+                            notify_and_rerun(f"{l_type}を使用しました")
+                        else: st.error(msg)
+                    else: st.error(f"残数が足りません (必要: {cost}, 残: {current_bal})")
+
+            st.divider()
+            if st.button("無断・通常欠勤 (¥1000)", width="stretch") and register_absence(user_id):
+                notify_and_rerun(f"欠勤を登録しました。(罰金{MAX_DAILY_FINE}円)")
+            with st.expander("特別欠勤 (¥0)"):
+                with st.form(key="sp_abs_form", clear_on_submit=True):
+                    reas = st.selectbox("理由", ["風邪(特殊)", "就活", "学校関連", "その他"])
+                    detail = st.text_input("詳細")
+                    if st.form_submit_button("確定", type="secondary"):
+                        final_reason = reas if reas != "その他" else detail
+                        success, msg = add_record(user_id, "特別欠勤", 0, final_reason)
+                        if success: notify_and_rerun("登録しました")
+                        else: st.error(msg)
+    else: st.info("👆 上のボックスから名前を選択してください")
+
+@tab_fragment
+def tab_fines(selected_user_name):
+    """「罰金集計」タブ"""
+    users = get_users_typed()
+    user_names = user_name_map(users)
+    st.subheader("🗓️ 罰金カレンダー")
+    now_t = datetime.now(JST)
+    c_y, c_m, c_u = st.columns([1, 1, 2])
+    sel_year = c_y.number_input("年", value=now_t.year, step=1)
+    sel_month = c_m.number_input("月", value=now_t.month, min_value=1, max_value=12, step=1)
+    def_index = list(user_names.keys()).index(selected_user_name) if selected_user_name in user_names else 0
+    cal_user = c_u.selectbox("表示する人", list(user_names.keys()), index=def_index)
+    cal_uid = user_names[cal_user]
+    
+    has_records = any(not get_snapshots()[name].get().empty for name in ("archive", "records"))
+    if has_records and not users.empty:
+        cal_html, total_fine = fine_calendar(cal_uid, sel_year, sel_month, cal_user)
+        st.markdown(cal_html, unsafe_allow_html=True)
+        st.info(f"💰 {cal_user} さんの {sel_month}月 罰金合計: ¥{int(total_fine):,}")
+        
+        st.divider()
+        st.subheader("📊 週別・累計リスト (全期間)")
+        st.dataframe(weekly_fine_table(), width="stretch")
+    else: st.info("データがありません")
+
+@tab_fragment
+def tab_leave():
+    """「休暇管理」タブ"""
+    users = get_users_typed()
+    st.write("#### 🔹 休暇可能な残数")
+    if not users.empty:
+        view_df = users[['name', 'rest_balance', 'paid_leave_balance']].copy()
+        view_df.columns = ['名前', '休み(残)', '有休(残)']
+        try: view_df['休み(残)'] = view_df['休み(残)'].astype(float)
+        except: pass
+        try: view_df['有休(残)'] = view_df['有休(残)'].astype(float)
+        except: pass
+        
+        usage = leave_usage_summary().reindex(users['id'], fill_value=0)
+        df_usage = pd.DataFrame({'名前': users['name'].to_numpy(), '休み(使用回数)': usage['rest_used'].to_numpy(), '有休(使用回数)': usage['paid_used'].to_numpy()})
+        c3_1, c3_2 = st.columns(2)
+        with c3_1: st.dataframe(view_df.style.format({'休み(残)': '{:.1f}', '有休(残)': '{:.1f}'}).map(lambda x: 'color:blue', subset=['休み(残)']).map(lambda x: 'color:green', subset=['有休(残)']), width="stretch")
+        with c3_2: st.dataframe(df_usage, width="stretch")
+
+@tab_fragment
+def tab_log():
+    """「全ログ」タブ"""
+    users = get_users_typed()
+    user_names = user_name_map(users)
+    index = log_index()
+    if index.df.empty: return
+    c_u, c_s, c_e, c_st = st.columns([2, 1, 1, 1])
+    log_user = c_u.selectbox("担当者", ["(全員)"] + list(user_names.keys()), key="log_user")
+    log_start = c_s.date_input("開始日", value=None, key="log_start")
+    log_end = c_e.date_input("終了日", value=None, key="log_end")
+    log_status = c_st.text_input("状態 (部分一致)", key="log_status")
+    positions = index.query(user_names.get(log_user), log_start and log_start.strftime('%Y-%m-%d'),
+                            log_end and log_end.strftime('%Y-%m-%d'), log_status.strip())
+    c_p, c_n, c_i = st.columns([1, 1, 2])
+    page_size = c_p.selectbox("表示件数", [50, 100, 200, 500], key="log_page_size")
+    pages = max(1, math.ceil(len(positions) / page_size))
+    if st.session_state.get("log_page", 1) > pages: st.session_state.log_page = 1 # 条件を変えてページ数が減ったとき
+    page = c_n.number_input("ページ", min_value=1, max_value=pages, step=1, key="log_page")
+    first = (page - 1) * page_size
+    c_i.caption(f"{len(positions)}件中 {min(first + 1, len(positions))}〜{min(first + page_size, len(positions))}件目 ({page}/{pages}ページ)")
+    rows = index.page(positions, page, page_size)
+    rows = rows.assign(name=rows['user_id'].astype(str).map({v: k for k, v in user_names.items()}))
+    st.dataframe(rows[['date', 'name', 'clock_in', 'clock_out', 'status', 'fine', 'note']], width="stretch", hide_index=True)
+
+@tab_fragment
+def tab_roster():
+    """「名簿登録」タブ"""
+    users = get_users_typed()
+    with st.form("reg_user", clear_on_submit=True):
+        nn = st.text_input("氏名")
+        if st.form_submit_button("登録"):
+            add_user(nn)
+            st.toast("登録しました"); st.success("登録しました"); t.sleep(2); st.rerun()
+    st.write("---")
+    if not users.empty:
+        for i, row in users.iterrows():
+            with st.expander(f"👤 {row['name']}"):
+                with st.form(key=f"edit_user_{row['id']}"):
+                    new_name_input = st.text_input("名前の修正", value=row['name'])
+                    if st.form_submit_button("更新"):
+                        if new_name_input != row['name']:
+                            success, msg_u = update_user_name(str(row['id']), new_name_input)
+                            if success: st.toast(msg_u); st.success(msg_u); t.sleep(3); st.rerun()
+                            else: st.error(msg_u)
+                        else: st.info("変更なし")
+                if st.button("削除 (注意)", key=f"del_{row['id']}"):
+                    if 'delete_confirm_id' in st.session_state and st.session_state.delete_confirm_id == row['id']:
+                        delete_user_data(str(row['id']))
+                        st.session_state.delete_confirm_id = None
+                        st.toast("削除しました"); st.success("削除しました"); t.sleep(2); st.rerun()
+                    else:
+                        st.session_state.delete_confirm_id = row['id']
+                        st.warning("もう一度押すと削除されます")
+
+@tab_fragment
+def tab_admin():
+    """「管理者」タブ"""
+    users = get_users_typed()
+    user_names = user_name_map(users)
+    st.write("### 🛠 管理者メニュー")
+    with st.expander("🚨 緊急用: 全員への休暇手動配布"):
+        c_f1, c_f2 = st.columns(2)
+        with c_f1:
+            if st.button("全員の「休み」を 1 にリセット", width="stretch"):
+                msg = admin_force_grant_all("rest")
+                st.toast(msg); st.success(msg)
+        with c_f2:
+            if st.button("全員の「有給」を 2 にリセット", width="stretch"):
+                msg = admin_force_grant_all("paid")
+                st.toast(msg); st.success(msg)
+        if st.button("全員の未登録日を一括で埋める", width="stretch"):
+            logs = auto_fill_missing_days_all()
+            msg = f"{len(logs)}名・{sum(len(v) for v in logs.values())}件を自動登録しました。"
+            st.toast(msg); st.success(msg)
+    if get_storage().name != "sheets":
+        with st.expander("💾 スプレッドシート連携"):
+            if st.button("スプレッドシートへ書き出し", width="stretch"):
+                msg = export_to_sheets()
+                st.toast(msg); st.success(msg)
+            confirm_import = st.checkbox("ローカルのデータをスプレッドシートの内容で上書きする")
+            if st.button("スプレッドシートから取り込み", disabled=not confirm_import, width="stretch"):
+                msg = import_from_sheets()
+                st.toast(msg); st.success(msg)
+    with st.expander("🔁 罰金の再計算 (ルール変更時)"):
+        st.caption(f"翌日に退勤した記録は早退にしません。{get_setting('next_day_mark_since', NEXT_DAY_MARK_SINCE)} より前の記録は"
+                   "翌日退勤の印 (備考の「(翌日退勤)」) が無いため、退勤時に早退にならなかったものは早退にしません。")
+        now_r = datetime.now(JST)
+        c_r1, c_r2 = st.columns(2)
+        rc_start = c_r1.date_input("開始日", value=date(now_r.year, now_r.month, 1), key="rc_start")
+        rc_end = c_r2.date_input("終了日", value=now_r.date(), key="rc_end")
+        c_r3, c_r4 = st.columns(2)
+        if c_r3.button("変更内容を確認", width="stretch"):
+            diff = recompute_fines(rc_start, rc_end, dry_run=True)
+            st.info(f"{len(diff)}件が変更されます")
+            if not diff.empty:
+                diff = diff.assign(name=diff['user_id'].astype(str).map(dict(zip(users['id'], users['name']))))
+                st.dataframe(diff[['date', 'name', 'status', 'new_status', 'fine', 'new_fine']], width="stretch")
+        if c_r4.button("再計算を実行", type="primary", width="stretch"):
+            diff = recompute_fines(rc_start, rc_end)
+            msg = f"{len(diff)}件のレコードを再計算しました。"
+            st.toast(msg); st.success(msg)
+    storage = get_storage()
+    if hasattr(storage, "retry_failed"): # JournaledStorage (再実行でクラスが作り直されるので isinstance は使えない)
+        with st.expander("📝 未反映の書き込み (write-behind)"):
+            pending_n, oldest_sec, failed = storage.status()
+            st.write(f"未反映: {pending_n}件 (最も古いもの: {oldest_sec:.0f}秒前)")
+            if not failed.empty:
+                st.warning(f"反映できなかった記録: {len(failed)}件")
+                st.dataframe(failed.assign(created=pd.to_datetime(failed['created'], unit='s', utc=True).dt.tz_convert(JST)), width="stretch", hide_index=True)
+                if st.button("保留中の記録を再送する", width="stretch"):
+                    storage.retry_failed()
+                    st.toast("再送を開始しました")
+    if storage.name == "sheets":
+        with st.expander("🗄 月別アーカイブ"):
+            months = storage.archive_months()
+            st.write(f"アーカイブ済み: {len(months)}か月" + (f" ({months[0]} 〜 {months[-1]})" if months else ""))
+            st.caption("先月以前の記録を records_YYYY-MM シートへ移し、records シートを今月分だけにします。他の端末で打刻が少ない時間に実行してください。")
+            if st.button("先月以前の記録をアーカイブへ移す", width="stretch"):
+                moved = rollover_records()
+                msg = f"{sum(moved.values())}件を{len(moved)}か月分のシートへ移しました。" if moved else "移す記録はありません。"
+                st.toast(msg); st.success(msg)
+    with st.expander("📈 API 呼び出しの計測"):
+        span = st.selectbox("集計期間", ["直近5分", "直近1時間", "直近24時間", "すべて"], index=1, key="metrics_span")
+        since = {"直近5分": 300, "直近1時間": 3600, "直近24時間": 86400}.get(span)
+        since = t.time() - since if since else 0.0
+        metrics = get_metrics()
+        summary = metrics.summary(since)
+        if summary.empty: st.info("記録がありません")
+        else:
+            st.dataframe(summary.style.format({'kb': '{:.1f}', 'p50_ms': '{:.0f}', 'p95_ms': '{:.0f}', 'p99_ms': '{:.0f}'}), width="stretch", hide_index=True)
+            errors = metrics.frame(since)
+            errors = errors[errors['error'] != ""]
+            if not errors.empty:
+                st.write("最近のエラー")
+                st.dataframe(errors.assign(ts=pd.to_datetime(errors['ts'], unit='s', utc=True).dt.tz_convert(JST)).iloc[::-1].head(50), width="stretch", hide_index=True)
+        st.download_button("JSON Lines で書き出し", metrics.to_jsonl(since), file_name="api_metrics.jsonl", mime="application/jsonl", width="stretch")
+    with st.expander("⏱ 起動時間 (最初の描画まで)"):
+        report = get_startup_report()
+        st.write(f"プロセス起動: {datetime.fromtimestamp(report.started_at, JST).strftime('%Y-%m-%d %H:%M:%S')}")
+        if report.first: st.dataframe(pd.DataFrame([report.first]), width="stretch", hide_index=True)
+        sessions = report.frame()
+        if not sessions.empty:
+            st.write(f"新しいセッションの最初の描画 ({len(sessions)}件)")
+            st.dataframe(sessions.drop(columns='ts').describe(percentiles=[0.5, 0.95]).T[['count', '50%', '95%', 'max']], width="stretch")
+    with st.expander("⏱ 再実行の内訳 (タブ別)"):
+        st.caption("main は全体の再実行 (見出しと選択中のタブを含む)。scope が fragment の行は、タブの中の操作でそのタブだけを再実行したもの")
+        costs = get_render_costs().summary(t.time() - 3600)
+        if costs.empty: st.info("記録がありません")
+        else: st.dataframe(costs.style.format({'last_ms': '{:.1f}', 'p50_ms': '{:.1f}', 'p95_ms': '{:.1f}'}), width="stretch", hide_index=True)
+    st.divider()
+    target_u = st.selectbox("対象者", ["(選択)"] + list(user_names.keys()), key="adm_u")
+    if target_u != "(選択)":
+        tid = user_names[target_u]
+        with st.expander("① 運用開始前の罰金 (繰越) 設定"):
+            current_init = users[users['id']==tid]['initial_fine'].iloc[0]
+            with st.form(key=f"init_fine_form_{tid}"):
+                new_init = st.number_input("運用前罰金額", value=int(current_init), step=100)
+                if st.form_submit_button("保存"):
+                    update_initial_fine(tid, new_init)
+                    st.toast("保存しました"); st.success("保存しました"); t.sleep(3); st.rerun()
+        with st.expander("② 休暇残数の個別修正"):
+            with st.form(key=f"balance_form_{tid}", clear_on_submit=True):
+                c1, c2 = st.columns(2)
+                with c1: r = st.number_input("休み 増減", step=0.5)
+                with c2: p = st.number_input("有休 増減", step=0.5)
+                if st.form_submit_button("更新"):
+                    if r != 0: update_user_balance(tid, "rest_balance", r)
+                    if p != 0: update_user_balance(tid, "paid_leave_balance", p)
+                    st.toast("更新しました"); st.success("更新しました"); t.sleep(3); st.rerun()
+        with st.expander("③ 日別レコードの修正"):
+            edit_date = st.date_input("修正する日付を選択", value=datetime.now(JST))
+            # GSheet直接接続ではなくキャッシュ (先月以前はアーカイブ) の索引から引く
+            index = log_index()
+            pos = index.find(tid, edit_date)
+            if pos is not None:
+                rec_row = index.df.iloc[pos]
+                rid = str(rec_row['id'])
+                st.info(f"現在: {rec_row['status']} | 罰金{rec_row['fine']}円")
+                with st.form("edit_record"):
+                    mode = st.radio("修正モード", ["自動計算 (時刻から判定)", "「全休」に変更", "「午前休」に変更", "「午後休」に変更", "「有休」に変更"])
+                    t_in_def = datetime.strptime(rec_row['clock_in'], '%H:%M:%S').time() if rec_row['clock_in'] and rec_row['clock_in'] != "-" else time(9,0)
+                    t_out_def = datetime.strptime(rec_row['clock_out'], '%H:%M:%S').time() if rec_row['clock_out'] and rec_row['clock_out'] != "-" else time(15,0)
+                    new_in_t = st.time_input("出勤時刻", value=t_in_def)
+                    new_out_t = st.time_input("退勤時刻", value=t_out_def)
+                    new_note = st.text_input("備考", value=rec_row['note'])
+                    if st.form_submit_button("修正を実行"):
+                        msg, m_type = admin_update_record(rid, edit_date, new_in_t, new_out_t, new_note, mode)
+                        if m_type == "error": st.error(msg)
                         else:
-                            css_class = "event-ok"
-                            text = status
-                        cell_content += f"<div class='event-box {css_class}'>{text}</div>"
-                html += f"<td>{cell_content}</td>"
-        html += "</tr>"
-    html += "</tbody></table></div>"
-    return html
+                            if m_type == "success": st.toast("修正完了！"); st.success(msg)
+                            else: st.toast("修正完了 (要確認)"); st.warning(msg)
+                            t.sleep(5); st.rerun()
+            else: st.warning("記録なし")
 
 def main():
     st.set_page_config(page_title="M1出勤管理", layout="wide")
     st.title(f"M1 出勤管理")
     
-    if 'init_done' not in st.session_state:
-        init_sheets()
-        st.session_state.init_done = True
+    RENDER_SCOPE.set("app")
+    if "notice" in st.session_state: st.toast(st.session_state.pop("notice"))
+    timer = PhaseTimer(SCRIPT_STARTED)
+    timer.mark("imports")
+    first_in_session = 'started' not in st.session_state
+    st.session_state.started = True
+    init_sheets()
+    timer.mark("init_sheets")
     
-    run_global_auto_grant()
-    auto_force_checkout()
+    if maintenance_in_page():
+        run_global_auto_grant()
+        auto_force_checkout()
+    timer.mark("maintenance")
 
-    users = get_users_stable()
+    users = get_users_typed()
+    timer.mark("load_users")
 
     if users.empty:
         st.warning("データを読み込んでいます...")
         user_names = {}
         if st.button("リロード"): st.rerun()
     else:
-        user_names = {row['name']: str(row['id']) for index, row in users.iterrows()}
+        user_names = user_name_map(users)
     
     if 'delete_confirm_id' not in st.session_state: st.session_state.delete_confirm_id = None
     if 'last_checked_user' not in st.session_state: st.session_state.last_checked_user = None
@@ -567,10 +2698,10 @@ def main():
     st.write("##### 👤 使用者を選択してください")
     selected_user_name = st.selectbox("名前を選択", ["(選択してください)"] + list(user_names.keys()), label_visibility="collapsed", key="main_user_selector")
     
-    if selected_user_name != "(選択してください)":
+    if selected_user_name != "(選択してください)" and maintenance_in_page():
         user_id = user_names[selected_user_name]
         if st.session_state.last_checked_user != user_id:
-            u_current = users[users['id'].astype(str) == user_id].iloc[0]
+            u_current = users[users['id'] == user_id].iloc[0]
             try: r_bal = float(u_current['rest_balance'])
             except: r_bal = 0.0
             filled_logs = auto_fill_missing_days(user_id, r_bal)
@@ -579,262 +2710,18 @@ def main():
                 for log in filled_logs: st.toast(f"自動登録: {log}")
                 t.sleep(2); st.rerun()
 
-    tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["打刻・申請", "罰金集計", "休暇管理", "全ログ", "名簿登録", "管理者"])
-
-    with tab1:
-        if selected_user_name != "(選択してください)":
-            user_id = user_names[selected_user_name]
-            u_row = users[users['id'].astype(str) == user_id].iloc[0]
-            st.write(f"### {selected_user_name} さんの操作")
-            col1, col2 = st.columns([1, 1])
-            with col1:
-                st.info(f"現在: {datetime.now(JST).strftime('%m/%d %H:%M')}")
-                is_holiday = is_weekend(datetime.now(JST))
-                holiday_chk = st.checkbox("祝日・休日出勤 (罰金なし)", value=is_holiday)
-                
-                if st.button("出勤 🟢", type="primary", use_container_width=True):
-                    now = datetime.now(JST)
-                    date_str = now.strftime('%Y-%m-%d')
-                    exists, rec = has_record_for_date(user_id, date_str)
-                    
-                    if exists:
-                        status_val = str(rec['status'])
-                        if "午前休" in status_val:
-                            fine, _ = calculate_late_fine(now, start_hour=WORK_SPLIT_HOUR)
-                            if fine > MAX_DAILY_FINE: fine = MAX_DAILY_FINE
-                            update_half_day_clock_in(user_id, now, fine, "(午前休出勤)")
-                            st.toast("出勤しました(午前休)"); st.success("出勤しました"); t.sleep(2); st.rerun()
-                        elif "午後休" in status_val:
-                            fine, _ = calculate_late_fine(now, start_hour=WORK_START_HOUR)
-                            if fine > MAX_DAILY_FINE: fine = MAX_DAILY_FINE
-                            update_half_day_clock_in(user_id, now, fine, "(午後休出勤)")
-                            st.toast("出勤しました(午後休)"); st.success("出勤しました"); t.sleep(2); st.rerun()
-                        else:
-                            st.error("本日は既に記録が存在します")
-                    else:
-                        fine, status = 0, "休日出勤"
-                        if not (is_holiday or holiday_chk): fine, status = calculate_late_fine(now)
-                        if fine > MAX_DAILY_FINE: fine = MAX_DAILY_FINE
-                        success, msg = add_record(user_id, status, fine, clock_in=now.strftime('%H:%M:%S'), note="土日祝" if (is_holiday or holiday_chk) else "")
-                        if success: st.toast(f"出勤しました ({status})"); st.success("出勤しました"); t.sleep(2); st.rerun()
-                        else: st.error(msg)
+    labels = ["打刻・申請", "罰金集計", "休暇管理", "全ログ", "名簿登録", "管理者"]
+    # 選択中のタブだけを描画する (タブを切り替えると再実行される)。タブの中の操作はそのタブだけを再実行する
+    tabs = st.tabs(labels, key="main_tab", on_change="rerun")
+    renders = [lambda: tab_punch(selected_user_name), lambda: tab_fines(selected_user_name), tab_leave, tab_log, tab_roster, tab_admin]
+    for tab, render in zip(tabs, renders):
+        if tab.open is False: continue
+        with tab: render()
 
-                with st.form(key="clock_out_form", clear_on_submit=True):
-                    note = st.text_input("退勤備考")
-                    if st.form_submit_button("退勤 🔴", use_container_width=True):
-                        now = datetime.now(JST)
-                        early_fine = 0
-                        if update_record_out(user_id, now, "退勤済", 0, note):
-                            st.toast("退勤しました"); st.success("退勤しました"); t.sleep(3); st.rerun()
-                        else: st.error("出勤記録が見つかりません")
-            with col2:
-                try: rest_b = float(u_row['rest_balance'])
-                except: rest_b = 0.0
-                try: paid_b = float(u_row['paid_leave_balance'])
-                except: paid_b = 0.0
-                st.markdown(f"""
-                <div style="background-color:#f0f2f6; padding:10px; border-radius:5px; margin-bottom:10px;">
-                    <strong>現在の残数:</strong> 休 <span style="font-size:1.2em; color:blue;">{rest_b:.1f}</span> / 有 <span style="font-size:1.2em; color:green;">{paid_b:.1f}</span>
-                </div>""", unsafe_allow_html=True)
-                
-                with st.form(key="leave_form", clear_on_submit=True):
-                    t_date = st.date_input("日付", value=datetime.now(JST))
-                    leave_option = st.selectbox("種類を選択", ["休み(全日) -1.0", "午前休(9-13時休み) -0.5", "午後休(13-15時休み) -0.5", "有給(全日) -1.0"])
-                    
-                    submitted = st.form_submit_button("申請・使用")
-                    
-                    if submitted:
-                        cost = 1.0
-                        l_type = "休み"
-                        target_bal = "rest_balance"
-                        if "午前休" in leave_option: cost = 0.5; l_type = "午前休"
-                        elif "午後休" in leave_option: cost = 0.5; l_type = "午後休"
-                        elif "有給" in leave_option: l_type = "有休"; target_bal = "paid_leave_balance"
-                        
-                        try: current_bal = float(u_row[target_bal])
-                        except: current_bal = 0.0
-                        
-                        if current_bal >= cost:
-                            success, msg = apply_leave(user_id, l_type, t_date, cost)
-                            if success:
-                                update_user_balance(user_id, target_bal, -cost)
-                                st.toast(f"{l_type}を使用しました"); st.success(f"{l_type}を使用しました"); t.sleep(3); st.rerun()
-                            else: st.error(msg)
-                        else: st.error(f"残数が足りません (必要: {cost}, 残: {current_bal})")
-
-                st.divider()
-                if st.button("無断・通常欠勤 (¥1000)", use_container_width=True): register_absence(user_id); t.sleep(3); st.rerun()
-                with st.expander("特別欠勤 (¥0)"):
-                    with st.form(key="sp_abs_form", clear_on_submit=True):
-                        reas = st.selectbox("理由", ["風邪(特殊)", "就活", "学校関連", "その他"])
-                        detail = st.text_input("詳細")
-                        if st.form_submit_button("確定", type="secondary"):
-                            final_reason = reas if reas != "その他" else detail
-                            success, msg = add_record(user_id, "特別欠勤", 0, final_reason)
-                            if success: st.toast("登録しました"); st.success("登録しました"); t.sleep(3); st.rerun()
-                            else: st.error(msg)
-        else: st.info("👆 上のボックスから名前を選択してください")
-
-    with tab2:
-        st.subheader("🗓️ 罰金カレンダー")
-        now_t = datetime.now(JST)
-        c_y, c_m, c_u = st.columns([1, 1, 2])
-        sel_year = c_y.number_input("年", value=now_t.year, step=1)
-        sel_month = c_m.number_input("月", value=now_t.month, min_value=1, max_value=12, step=1)
-        def_index = list(user_names.keys()).index(selected_user_name) if selected_user_name in user_names else 0
-        cal_user = c_u.selectbox("表示する人", list(user_names.keys()), index=def_index)
-        cal_uid = user_names[cal_user]
-        
-        df = get_records_stable()
-        if not df.empty and not users.empty:
-            df['date_dt'] = pd.to_datetime(df['date'])
-            df_m = df[(df['date_dt'].dt.year == sel_year) & (df['date_dt'].dt.month == sel_month) & (df['user_id'].astype(str) == cal_uid)].copy()
-            df_m['fine'] = pd.to_numeric(df_m['fine'], errors='coerce').fillna(0)
-            cal_html = generate_calendar_html(sel_year, sel_month, df_m, cal_user)
-            st.markdown(cal_html, unsafe_allow_html=True)
-            total_fine = df_m['fine'].sum()
-            st.info(f"💰 {cal_user} さんの {sel_month}月 罰金合計: ¥{int(total_fine):,}")
-            
-            st.divider()
-            st.subheader("📊 週別・累計リスト (全期間)")
-            df_all_m = df.copy()
-            df_all_m['date_dt'] = pd.to_datetime(df_all_m['date'])
-            df_all_m['fine'] = pd.to_numeric(df_all_m['fine'], errors='coerce').fillna(0)
-            users['id'] = users['id'].astype(str)
-            if not df_all_m.empty:
-                df_all_m['user_id'] = df_all_m['user_id'].astype(str)
-                merged = pd.merge(df_all_m, users[['id', 'name']], left_on='user_id', right_on='id', how='left')
-                merged['week'] = merged['date'].apply(get_week_label)
-                pivot = merged.pivot_table(index='name', columns='week', values='fine', aggfunc='sum', fill_value=0)
-            else: pivot = pd.DataFrame()
-            u_init = users[['name', 'initial_fine']].set_index('name')
-            u_init['initial_fine'] = pd.to_numeric(u_init['initial_fine'], errors='coerce').fillna(0)
-            pivot = pivot.join(u_init, how='outer').fillna(0)
-            pivot.rename(columns={'initial_fine': '運用前罰金'}, inplace=True)
-            pivot['Total'] = pivot.sum(axis=1)
-            cols = [c for c in pivot.columns if c not in ['運用前罰金', 'Total']]
-            cols.sort()
-            final_cols = ['運用前罰金'] + cols + ['Total']
-            st.dataframe(pivot[final_cols], use_container_width=True)
-        else: st.info("データがありません")
-
-    with tab3:
-        st.write("#### 🔹 休暇可能な残数")
-        if not users.empty:
-            view_df = users[['name', 'rest_balance', 'paid_leave_balance']].copy()
-            view_df.columns = ['名前', '休み(残)', '有休(残)']
-            try: view_df['休み(残)'] = view_df['休み(残)'].astype(float)
-            except: pass
-            try: view_df['有休(残)'] = view_df['有休(残)'].astype(float)
-            except: pass
-            
-            df_r = get_records_stable()
-            usage_data = []
-            if not df_r.empty:
-                df_r['user_id'] = df_r['user_id'].astype(str)
-                for idx, u_row in users.iterrows():
-                    uid = str(u_row['id'])
-                    u_recs = df_r[df_r['user_id'] == uid]
-                    rest_used = len(u_recs[u_recs['status'].str.contains('休み|午前休|午後休', na=False)])
-                    paid_used = len(u_recs[u_recs['status'].str.contains('有休', na=False)])
-                    usage_data.append({'名前': u_row['name'], '休み(使用回数)': rest_used, '有休(使用回数)': paid_used})
-            df_usage = pd.DataFrame(usage_data)
-            if df_usage.empty: df_usage = pd.DataFrame(columns=['名前', '休み(使用回数)', '有休(使用回数)'])
-            c3_1, c3_2 = st.columns(2)
-            with c3_1: st.dataframe(view_df.style.format({'休み(残)': '{:.1f}', '有休(残)': '{:.1f}'}).applymap(lambda x: 'color:blue', subset=['休み(残)']).applymap(lambda x: 'color:green', subset=['有休(残)']), use_container_width=True)
-            with c3_2: st.dataframe(df_usage, use_container_width=True)
-
-    with tab4:
-        df = get_records_stable()
-        if not df.empty:
-            users['id'] = users['id'].astype(str)
-            df['user_id'] = df['user_id'].astype(str)
-            merged = pd.merge(df, users[['id', 'name']], left_on='user_id', right_on='id', how='left')
-            merged['fine'] = pd.to_numeric(merged['fine'], errors='coerce').fillna(0).astype(int)
-            st.dataframe(merged[['date', 'name', 'clock_in', 'clock_out', 'status', 'fine', 'note']].iloc[::-1], use_container_width=True)
-
-    with tab5:
-        with st.form("reg_user", clear_on_submit=True):
-            nn = st.text_input("氏名")
-            if st.form_submit_button("登録"):
-                add_user(nn)
-                st.toast("登録しました"); st.success("登録しました"); t.sleep(2); st.rerun()
-        st.write("---")
-        if not users.empty:
-            for i, row in users.iterrows():
-                with st.expander(f"👤 {row['name']}"):
-                    with st.form(key=f"edit_user_{row['id']}"):
-                        new_name_input = st.text_input("名前の修正", value=row['name'])
-                        if st.form_submit_button("更新"):
-                            if new_name_input != row['name']:
-                                success, msg_u = update_user_name(str(row['id']), new_name_input)
-                                if success: st.toast(msg_u); st.success(msg_u); t.sleep(3); st.rerun()
-                                else: st.error(msg_u)
-                            else: st.info("変更なし")
-                    if st.button("削除 (注意)", key=f"del_{row['id']}"):
-                        if 'delete_confirm_id' in st.session_state and st.session_state.delete_confirm_id == row['id']:
-                            delete_user_data(str(row['id']))
-                            st.session_state.delete_confirm_id = None
-                            st.toast("削除しました"); st.success("削除しました"); t.sleep(2); st.rerun()
-                        else:
-                            st.session_state.delete_confirm_id = row['id']
-                            st.warning("もう一度押すと削除されます")
-
-    with tab6:
-        st.write("### 🛠 管理者メニュー")
-        with st.expander("🚨 緊急用: 全員への休暇手動配布"):
-            c_f1, c_f2 = st.columns(2)
-            with c_f1:
-                if st.button("全員の「休み」を 1 にリセット", use_container_width=True):
-                    msg = admin_force_grant_all("rest")
-                    st.toast(msg); st.success(msg)
-            with c_f2:
-                if st.button("全員の「有給」を 2 にリセット", use_container_width=True):
-                    msg = admin_force_grant_all("paid")
-                    st.toast(msg); st.success(msg)
-        st.divider()
-        target_u = st.selectbox("対象者", ["(選択)"] + list(user_names.keys()), key="adm_u")
-        if target_u != "(選択)":
-            tid = user_names[target_u]
-            with st.expander("① 運用開始前の罰金 (繰越) 設定"):
-                current_init = users[users['id'].astype(str)==tid]['initial_fine'].iloc[0]
-                with st.form(key=f"init_fine_form_{tid}"):
-                    new_init = st.number_input("運用前罰金額", value=int(current_init), step=100)
-                    if st.form_submit_button("保存"):
-                        update_initial_fine(tid, new_init)
-                        st.toast("保存しました"); st.success("保存しました"); t.sleep(3); st.rerun()
-            with st.expander("② 休暇残数の個別修正"):
-                with st.form(key=f"balance_form_{tid}", clear_on_submit=True):
-                    c1, c2 = st.columns(2)
-                    with c1: r = st.number_input("休み 増減", step=0.5)
-                    with c2: p = st.number_input("有休 増減", step=0.5)
-                    if st.form_submit_button("更新"):
-                        if r != 0: update_user_balance(tid, "rest_balance", r)
-                        if p != 0: update_user_balance(tid, "paid_leave_balance", p)
-                        st.toast("更新しました"); st.success("更新しました"); t.sleep(3); st.rerun()
-            with st.expander("③ 日別レコードの修正"):
-                edit_date = st.date_input("修正する日付を選択", value=datetime.now(JST))
-                # GSheet直接接続ではなくキャッシュ関数を利用
-                df_r = get_records_stable()
-                edit_date_str = edit_date.strftime('%Y-%m-%d')
-                rec = df_r[(df_r['user_id'].astype(str) == tid) & (df_r['date'] == edit_date_str)]
-                if not rec.empty:
-                    rec_row = rec.iloc[0]
-                    rid = str(rec_row['id'])
-                    st.info(f"現在: {rec_row['status']} | 罰金{rec_row['fine']}円")
-                    with st.form("edit_record"):
-                        mode = st.radio("修正モード", ["自動計算 (時刻から判定)", "「全休」に変更", "「午前休」に変更", "「午後休」に変更", "「有休」に変更"])
-                        t_in_def = datetime.strptime(rec_row['clock_in'], '%H:%M:%S').time() if rec_row['clock_in'] and rec_row['clock_in'] != "-" else time(9,0)
-                        t_out_def = datetime.strptime(rec_row['clock_out'], '%H:%M:%S').time() if rec_row['clock_out'] and rec_row['clock_out'] != "-" else time(15,0)
-                        new_in_t = st.time_input("出勤時刻", value=t_in_def)
-                        new_out_t = st.time_input("退勤時刻", value=t_out_def)
-                        new_note = st.text_input("備考", value=rec_row['note'])
-                        if st.form_submit_button("修正を実行"):
-                            msg, m_type = admin_update_record(rid, edit_date, new_in_t, new_out_t, new_note, mode)
-                            if m_type == "success": st.toast("修正完了！"); st.success(msg)
-                            else: st.toast("修正完了 (要確認)"); st.warning(msg)
-                            t.sleep(5); st.rerun()
-                else: st.warning("記録なし")
+    timer.mark("render")
+    get_startup_report().add(timer, first_in_session)
+    get_render_costs().record("main", sum(timer.phases.values()))
+    RENDER_SCOPE.set("fragment") # この後のタブだけの再実行と区別する
 
 if __name__ == '__main__':
     main()
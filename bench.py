@@ -0,0 +1,347 @@
+"""オフラインのベンチマーク。
+
+Google Sheets の代わりにメモリ上の疑似スプレッドシート (SimSpreadsheet) を使い、
+app.py の実際の関数を呼び出して、操作ごとの API 呼び出し回数・送受信バイト数・
+待ち時間 (1回あたりの遅延と転送量から求めた模擬値) を測る。ネットワークは使わない。
+
+    python bench.py                                   # 20人×1千件, 200人×10万件
+    python bench.py --sizes 2000:1000000              # 大きいデータ
+    python bench.py --latency-ms 200 --quota 60 --json bench.jsonl
+    python bench.py --archive                         # 先月以前を月別シートへ移してから測る
+
+--quota は1分あたりの読み取り・書き込みそれぞれの上限で、超えた呼び出しは
+429 (RESOURCE_EXHAUSTED) の APIError になる。分の区切りは模擬時刻で数える。
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time as t
+import uuid
+from collections import Counter
+from datetime import datetime, date, timedelta
+
+os.environ["ATTENDANCE_STORAGE_BACKEND"] = "sheets"
+os.environ["ATTENDANCE_SNAPSHOT_DIR"] = "" # 毎回シートから読み込んで測る
+logging.disable(logging.WARNING) # streamlit を実行環境なしで読み込んだときの警告を抑える
+
+import gspread
+from gspread.utils import a1_to_rowcol, numericise_all, to_records
+
+import app
+
+# --- 疑似スプレッドシート ---
+class SimResponse:
+    """APIError に渡すための最小限のレスポンス"""
+    status_code = 429
+    text = "Quota exceeded"
+
+    def json(self):
+        return {"error": {"code": 429, "message": "Quota exceeded for quota metric 'Read requests'", "status": "RESOURCE_EXHAUSTED"}}
+
+def payload_size(rows):
+    # JSON で送受信したときのおおよそのバイト数
+    return sum(len(str(v).encode()) + 3 for row in rows for v in row) + 2 * len(rows) + 2
+
+class SimSpreadsheet:
+    """gspread.Spreadsheet の代わり。呼び出しごとに回数・バイト数・模擬時刻を記録する"""
+    def __init__(self, latency_ms=150.0, ms_per_kb=0.5, quota=60, sleep=False):
+        self.latency_ms = latency_ms
+        self.ms_per_kb = ms_per_kb
+        self.quota = quota
+        self.sleep = sleep
+        self.sheets = {}
+        self.clock = 0.0 # 模擬時刻 (秒)
+        self.reset()
+
+    def reset(self):
+        self.calls = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = 0.0
+        self.errors = Counter()
+        self.window = {"read": [], "write": []}
+
+    def api(self, kind, method, sent=0, received=0):
+        """1回の API 呼び出し。上限を超えていれば 429 を返す"""
+        window = self.window[kind]
+        while window and window[0] <= self.clock - 60: window.pop(0)
+        delay = (self.latency_ms + (sent + received) / 1024 * self.ms_per_kb) / 1000
+        self.calls[method] += 1
+        self.clock += delay
+        self.latency += delay
+        if self.sleep: t.sleep(delay)
+        if self.quota and len(window) >= self.quota:
+            self.errors[f"{method}:429"] += 1
+            raise gspread.exceptions.APIError(SimResponse())
+        window.append(self.clock)
+        self.bytes_sent += sent
+        self.bytes_received += received
+
+    def add_worksheet(self, title, rows=100, cols=10, **kw):
+        self.api("write", "add_worksheet", sent=64)
+        self.sheets[title] = SimWorksheet(self, title, len(self.sheets))
+        return self.sheets[title]
+
+    def del_worksheet(self, worksheet):
+        self.api("write", "del_worksheet", sent=64)
+        self.sheets = {k: v for k, v in self.sheets.items() if v.id != worksheet.id}
+
+    def worksheet(self, title):
+        self.api("read", "worksheet", received=200) # シートのメタデータ取得
+        if title not in self.sheets: raise gspread.exceptions.WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def worksheets(self, **kw):
+        self.api("read", "worksheets", received=200 * len(self.sheets))
+        return list(self.sheets.values())
+
+    def values_batch_update(self, body):
+        self.api("write", "values_batch_update", sent=payload_size([v for d in body["data"] for v in d["values"]]))
+        for d in body["data"]:
+            title, rng = d["range"].rsplit("!", 1)
+            self.sheets[title.strip("'")].write(rng.split(":")[0], d["values"])
+        return {"totalUpdatedCells": sum(len(v) for d in body["data"] for v in d["values"])}
+
+    def values_batch_get(self, ranges, params=None):
+        results = []
+        for r in ranges:
+            title, _, rng = r.rpartition("!")
+            sheet = self.sheets[(title or rng).strip("'")]
+            results.append({"range": r, "values": sheet.read(rng) if title else [list(row) for row in sheet.rows]})
+        self.api("read", "values_batch_get", received=sum(payload_size(v["values"]) for v in results))
+        return {"valueRanges": results}
+
+    def batch_update(self, body):
+        # 行の削除 (deleteDimension) だけに対応する
+        self.api("write", "batch_update", sent=payload_size([[json.dumps(req)] for req in body["requests"]]))
+        by_id = {ws.id: ws for ws in self.sheets.values()}
+        for req in body["requests"]:
+            rng = req["deleteDimension"]["range"]
+            sheet = by_id[rng["sheetId"]]
+            del sheet.rows[rng["startIndex"]:rng["endIndex"]]
+            sheet.size = None
+        return {"replies": [{} for _ in body["requests"]]}
+
+class SimWorksheet:
+    def __init__(self, sh, title, sheet_id=0):
+        self.sh = sh
+        self.title = title
+        self.id = sheet_id
+        self.rows = []
+        self.size = None # 全体のバイト数 (書き込みのたびに数え直す)
+
+    def sheet_size(self):
+        if self.size is None: self.size = payload_size(self.rows)
+        return self.size
+
+    def write(self, a1, values):
+        r, c = a1_to_rowcol(a1)
+        for i, row in enumerate(values):
+            while len(self.rows) < r + i: self.rows.append([])
+            target = self.rows[r + i - 1]
+            for j, v in enumerate(row):
+                while len(target) < c + j: target.append("")
+                target[c + j - 1] = "" if v is None else str(v)
+        self.size = None
+
+    def read(self, rng):
+        """A1 形式の範囲 (A5 / A5:H9 / A5:H / A:H) の値"""
+        start, _, end = rng.partition(":")
+        start_col = start.rstrip("0123456789")
+        end_col = end.rstrip("0123456789") or start_col
+        start_row, end_row = start[len(start_col):], end[len(end_col):]
+        c1, c2 = (a1_to_rowcol(f"{col}1")[1] for col in (start_col, end_col))
+        r1 = int(start_row) if start_row else 1
+        r2 = int(end_row) if end_row else (len(self.rows) if end or not start_row else r1)
+        out = [self.rows[r - 1][c1 - 1:c2] for r in range(r1, min(r2, len(self.rows)) + 1)]
+        while out and not any(out[-1]): out.pop()
+        return out
+
+    def get_all_values(self, **kw):
+        self.sh.api("read", "get_all_values", received=self.sheet_size())
+        return [list(r) for r in self.rows]
+
+    def get_all_records(self, **kw):
+        self.sh.api("read", "get_all_records", received=self.sheet_size())
+        if not self.rows: return []
+        head = self.rows[0]
+        return to_records(head, [numericise_all(r + [""] * (len(head) - len(r))) for r in self.rows[1:]])
+
+    def batch_get(self, ranges, **kw):
+        results = [self.read(r) for r in ranges]
+        self.sh.api("read", "batch_get", received=sum(payload_size(v) for v in results))
+        return results
+
+    def col_values(self, col, **kw):
+        values = [row[col - 1] if len(row) >= col else "" for row in self.rows]
+        self.sh.api("read", "col_values", received=payload_size([[v] for v in values]))
+        return values
+
+    def find(self, query, in_column=None, **kw):
+        # gspread の find はシート全体を取得してから手元で探す
+        self.sh.api("read", "find", received=self.sheet_size())
+        for i, row in enumerate(self.rows):
+            for j, v in enumerate(row):
+                if (in_column is None or j + 1 == in_column) and v == query: return gspread.Cell(i + 1, j + 1, v)
+        return None
+
+    def cell(self, row, col, **kw):
+        self.sh.api("read", "cell", received=64)
+        try: value = self.rows[row - 1][col - 1]
+        except IndexError: value = ""
+        return gspread.Cell(row, col, numericise_all([value])[0])
+
+    def append_rows(self, values, **kw):
+        self.sh.api("write", "append_rows", sent=payload_size(values))
+        start = len(self.rows) + 1
+        self.rows += [["" if v is None else str(v) for v in row] for row in values]
+        self.size = None
+        return {"updates": {"updatedRange": f"'{self.title}'!A{start}:H{len(self.rows)}", "updatedRows": len(values)}}
+
+    def append_row(self, values, **kw):
+        return self.append_rows([values], **kw)
+
+    def delete_rows(self, start, end=None):
+        self.sh.api("write", "delete_rows", sent=64)
+        del self.rows[start - 1:(end or start)]
+        self.size = None
+
+    def clear(self):
+        self.sh.api("write", "clear", sent=64)
+        self.rows = []
+        self.size = None
+
+    def update(self, values=None, range_name=None, **kw):
+        self.sh.api("write", "update", sent=payload_size(values))
+        self.write(range_name or "A1", values)
+
+# --- 時刻の固定 ---
+class FrozenDatetime(datetime):
+    """app.datetime の代わり。now() は固定した時刻を返す"""
+    frozen = None
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.frozen
+
+NOW = FrozenDatetime(2025, 9, 15, 10, 0, 0, tzinfo=app.JST) # 月曜日 (週次付与の対象日)
+
+# --- 合成データ ---
+def build_dataset(sh, n_users, n_records, seed=0):
+    """n_users 人・n_records 件のシートを作る。
+
+    既存のレコードは先月以前の日付だけ (今月分は自動補完の対象になる)。
+    1% の人は前日の退勤が未入力 (強制退勤の対象)。
+    """
+    rng = random.Random(seed)
+    new_id = lambda: str(uuid.UUID(int=rng.getrandbits(128), version=4))
+    last_week = (NOW - timedelta(days=7)).strftime("%Y-%W")
+    users = [[new_id(), f"user{i:05}", "2", "2", "0", last_week, NOW.strftime("%Y-%m")] for i in range(n_users)]
+    first_day = date(NOW.year, NOW.month, 1)
+    statuses = ["通常", "通常", "通常", "遅刻(10分)", "休み", "有休", "午前休", "欠勤"]
+    records = []
+    for _ in range(n_records):
+        uid = users[rng.randrange(n_users)][0]
+        day = first_day - timedelta(days=rng.randint(1, 730))
+        status = rng.choice(statuses)
+        fine = {"遅刻(10分)": 100, "欠勤": 1000}.get(status, 0)
+        clock = ("09:00:00", "15:00:00") if status in ("通常", "遅刻(10分)", "午前休") else ("-", "-")
+        records.append([new_id(), uid, day.isoformat(), clock[0], clock[1], status, str(fine), ""])
+    yesterday = (NOW - timedelta(days=1)).strftime("%Y-%m-%d")
+    for u in users[3::100]:
+        records.append([new_id(), u[0], yesterday, "09:00:00", "", "通常", "0", ""])
+    sh.add_worksheet("users").rows = [list(app.USER_COLS)] + users
+    sh.add_worksheet("records").rows = [list(app.RECORD_COLS)] + records
+    return [u[0] for u in users]
+
+# --- 計測 ---
+def reset_app(sh):
+    """プロセス単位のキャッシュを捨てて、疑似スプレッドシートにつなぎ直す"""
+    app.connect_to_gsheets = lambda: sh
+    app.datetime = FrozenDatetime
+    FrozenDatetime.frozen = NOW
+    for cached in (app.get_storage, app.get_snapshots, app.get_views, app.get_grant_state): cached.clear()
+    # 書き込み後の再取得もその操作の分として数えるため、バックグラウンドではなくその場で行う
+    app.SharedSnapshot.request_refresh = lambda self: self.refresh()
+    app.st.session_state.clear()
+
+def operations(ids, archive=False):
+    a, b, c = ids[0], ids[1 % len(ids)], ids[2 % len(ids)]
+    # 先月 (--archive ではアーカイブのシートから読む)
+    last_month_end = date(NOW.year, NOW.month, 1) - timedelta(days=1)
+    last_month_start = last_month_end.replace(day=1)
+    return [("rollover_records", app.rollover_records)] * archive + [
+        ("initial_load", lambda: (app.get_users_stable(), app.get_records_stable())),
+        ("add_record", lambda: app.add_record(a, "通常", 0, clock_in=NOW.strftime('%H:%M:%S'))),
+        ("update_record_out", lambda: app.update_record_out(a, NOW.replace(hour=15, minute=5), "退勤済", 0, "")),
+        ("apply_leave", lambda: app.apply_leave(b, "休み", (NOW + timedelta(days=1)).date(), 1.0)),
+        ("auto_fill_missing_days", lambda: app.auto_fill_missing_days(c, 2.0)),
+        ("run_global_auto_grant", app.run_global_auto_grant),
+        ("auto_force_checkout", app.auto_force_checkout),
+        ("admin_force_grant_all", lambda: app.admin_force_grant_all("rest")),
+        ("find_record_last_month", lambda: app.has_record_for_date(b, (last_month_end - timedelta(days=3)).isoformat())),
+        ("recompute_last_month", lambda: app.recompute_fines(last_month_start, last_month_end, dry_run=True)),
+    ]
+
+def run_size(n_users, n_records, args):
+    sh = SimSpreadsheet(args.latency_ms, args.ms_per_kb, args.quota, args.sleep)
+    ids = build_dataset(sh, n_users, n_records, args.seed)
+    reset_app(sh)
+    results = []
+    for name, op in operations(ids, args.archive):
+        sh.reset()
+        error = ""
+        started = t.perf_counter()
+        try: op()
+        except Exception as e: error = f"{type(e).__name__}: {e}"
+        wall = t.perf_counter() - started
+        results.append({"users": n_users, "records": n_records, "op": name,
+                        "calls": sum(sh.calls.values()), "by_method": dict(sh.calls),
+                        "bytes_sent": sh.bytes_sent, "bytes_received": sh.bytes_received,
+                        "api_ms": round(sh.latency * 1000, 1), "wall_ms": round(wall * 1000, 1),
+                        "errors_429": sum(sh.errors.values()), "error": error})
+    return results
+
+def print_table(results):
+    head = f"{'users':>6} {'records':>8}  {'operation':<24}{'calls':>6} {'KB out':>9} {'KB in':>10} {'api ms':>9} {'wall ms':>9} {'429':>4}  methods"
+    print(head)
+    print("-" * len(head))
+    for r in results:
+        methods = " ".join(f"{k}={v}" for k, v in sorted(r["by_method"].items()))
+        print(f"{r['users']:>6} {r['records']:>8}  {r['op']:<24}{r['calls']:>6} {r['bytes_sent'] / 1024:>9.1f} {r['bytes_received'] / 1024:>10.1f} "
+              f"{r['api_ms']:>9.1f} {r['wall_ms']:>9.1f} {r['errors_429']:>4}  {methods}{'  !! ' + r['error'] if r['error'] else ''}")
+
+def parse_sizes(text):
+    sizes = []
+    for item in text.split(","):
+        n_users, n_records = item.split(":")
+        sizes.append((int(n_users), int(n_records)))
+    return sizes
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="疑似スプレッドシートで app.py の操作ごとの API コストを測る")
+    parser.add_argument("--sizes", type=parse_sizes, default=parse_sizes("20:1000,200:100000"),
+                        help="人数:件数 をカンマ区切りで (例: 20:1000,200:100000,2000:1000000)")
+    parser.add_argument("--latency-ms", type=float, default=150.0, help="1回の呼び出しの遅延 (ミリ秒)")
+    parser.add_argument("--ms-per-kb", type=float, default=0.5, help="転送量 1KB あたりの追加の遅延 (ミリ秒)")
+    parser.add_argument("--quota", type=int, default=60, help="1分あたりの読み取り・書き込みの上限 (0 で無制限)")
+    parser.add_argument("--sleep", action="store_true", help="模擬の遅延を実際に sleep する")
+    parser.add_argument("--archive", action="store_true", help="最初に先月以前の記録を月別シートへ移し (rollover)、その後の操作を測る")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="PATH", help="結果を JSON Lines で書き出す")
+    args = parser.parse_args(argv)
+
+    results = []
+    for n_users, n_records in args.sizes:
+        results += run_size(n_users, n_records, args)
+    print_table(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            for r in results: f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    return 1 if any(r["error"] for r in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
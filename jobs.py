@@ -0,0 +1,112 @@
+"""定期メンテナンスのバッチ (画面を開かずに実行する)。
+
+app.py の関数をそのまま使い、全員分を1回で処理する。
+
+    python jobs.py                     # grant → fill → checkout の順に実行 (rollover は含まない)
+    python jobs.py checkout fill       # 指定したものだけ (順番は下の一覧と同じ)
+    python jobs.py rollover            # 月別アーカイブ (画面を止めてから手動で)
+    python jobs.py --list              # ジョブの一覧
+
+  grant     週次・月次の休暇付与 (月曜 休み+1.0 / 1日 有休+2.0。付与済みの人は対象外)
+  fill      今月1日から昨日までの未登録の平日を 休み (残があれば) / 欠勤 で埋める
+  checkout  前日以前 (23:55 を過ぎたら当日も) の未退勤を 23:55 で締める (fill で埋めた行も)
+  rollover  先月以前の records を月別のアーカイブシートへ移す (sheets のときだけ)。
+            records の行が詰まり、動いている画面のプロセスが持つ行の位置とずれるので、
+            既定では実行しない。画面を止めている間に名前を指定して実行する
+
+既定のジョブは1日1回、日付が変わった直後に実行する。例:
+
+    # crontab (サーバーのタイムゾーンが JST のとき)
+    5 0 * * * cd /path/to/app && python jobs.py >> jobs.log 2>&1
+
+    # systemd: attendance-jobs.service (Type=oneshot, WorkingDirectory=/path/to/app,
+    #          ExecStart=/usr/bin/python3 jobs.py) と
+    #          attendance-jobs.timer (OnCalendar=*-*-* 00:05:00 Asia/Tokyo, Persistent=true)
+
+設定は app.py と同じ (環境変数 ATTENDANCE_<KEY> → .streamlit/secrets.toml)。
+画面側は設定 maintenance が "jobs" (既定) のとき定期処理を行わない。
+
+同時に1つだけ動くよう、ロックファイル (設定 job_lock_path、既定 jobs.lock) を flock で取る。
+取れなければ何もせずに終わる。画面の定期付与 (maintenance が "page") も同じロックを取る。
+ロックは同じマシンの中だけで有効なので、実行するマシン (と画面のプロセス) は1台にする。
+書き込みは journal を通さず直接シートへ書く (画面のプロセスの journal と混ざらないように)。
+そのため画面のプロセスの journal (設定 journal_path、既定 journal.db) にシートへ未反映の記録が
+残っているときは何もせずに終わる (未反映の出勤を見落として fill が欠勤を入れないように)。
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time as t
+import traceback
+from datetime import datetime
+
+os.environ.setdefault("ATTENDANCE_WRITE_MODE", "direct")
+os.environ.setdefault("ATTENDANCE_SNAPSHOT_DIR", "") # 画面のプロセスが保存したスナップショットを上書きしない
+logging.disable(logging.WARNING) # streamlit を実行環境なしで読み込んだときの警告を抑える
+
+import app
+
+def summarize_fill(logs):
+    return f"{sum(len(v) for v in logs.values())}件を登録 ({len(logs)}名)"
+
+# 名前 -> (説明, 実行する関数, 結果の要約)
+JOBS = {
+    "grant": ("週次・月次の休暇付与", app.grant_periodic_leave, lambda msgs: f"{len(msgs)}件" + "".join(f"\n  {m}" for m in msgs)),
+    "fill": ("未登録日の自動登録 (全員)", app.auto_fill_missing_days_all, summarize_fill),
+    "checkout": ("未退勤の強制退勤", app.force_checkout, lambda n: f"{n}件を締めました"),
+    "rollover": ("先月以前の月別アーカイブ", app.rollover_records, lambda moved: ", ".join(f"{m}: {n}件" for m, n in moved.items()) or "なし"),
+}
+# 名前を指定しないときに実行するジョブ
+DEFAULT_JOBS = ["grant", "fill", "checkout"]
+
+def pending_journal(path):
+    """journal に残っている (シートへ未反映・保留中の) 記録の件数。journal が無ければ 0"""
+    if not os.path.exists(path): return 0
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try: return conn.execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+    except sqlite3.OperationalError: return 0 # まだ journal のテーブルが無い
+    finally: conn.close()
+
+def run_jobs(names, out=sys.stdout):
+    """names のジョブを JOBS の順に実行する。失敗したジョブがあっても残りは続ける。失敗した数を返す"""
+    failed = 0
+    app.ensure_sheets() # 接続できなければここで失敗させる (init_sheets は画面にエラーを出すだけ)
+    for name in [n for n in JOBS if n in names]:
+        label, func, summarize = JOBS[name]
+        started = t.perf_counter()
+        try: result = func()
+        except Exception:
+            failed += 1
+            print(f"[{name}] {label}: 失敗\n{traceback.format_exc()}", file=out)
+            continue
+        print(f"[{name}] {label}: {summarize(result)} ({(t.perf_counter() - started) * 1000:.0f} ms)", file=out)
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="定期メンテナンス (休暇付与・強制退勤・未登録日の自動登録・月別アーカイブ) を実行する")
+    parser.add_argument("jobs", nargs="*", metavar="JOB", help=f"実行するジョブ ({' / '.join(JOBS)}。省略すると {' / '.join(DEFAULT_JOBS)})")
+    parser.add_argument("--list", action="store_true", help="ジョブの一覧を表示して終わる")
+    parser.add_argument("--lock", default=None, help="ロックファイル (既定は設定 job_lock_path、なければ jobs.lock)")
+    args = parser.parse_args(argv)
+    unknown = [n for n in args.jobs if n not in JOBS]
+    if unknown: parser.error(f"不明なジョブ: {', '.join(unknown)}")
+    if args.list:
+        for name, (label, _, _) in JOBS.items(): print(f"{name:10} {label}")
+        return 0
+    lock = app.job_lock(args.lock)
+    if lock is None:
+        print("他の jobs.py が実行中のため何もしません")
+        return 0
+    with lock:
+        print(f"--- {datetime.now(app.JST):%Y-%m-%d %H:%M:%S} ({app.get_setting('storage_backend', 'sheets')})")
+        if app.get_setting("storage_backend", "sheets") == "sheets":
+            pending = pending_journal(app.get_setting("journal_path", "journal.db"))
+            if pending:
+                print(f"画面のプロセスの journal にシートへ未反映の記録が{pending}件あるため何もしません (反映後に再実行してください)")
+                return 1
+        return 1 if run_jobs(args.jobs or DEFAULT_JOBS) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())